@@ -1,18 +1,28 @@
 #!/usr/bin/python3
 
 import argparse
+import json
 import logging
 import os
 from packaging.version import Version
 from pathlib import Path
 import shutil
-import subprocess
-from subprocess import PIPE, Popen
+import sys
+from subprocess import PIPE
+from typing import Dict, List, Tuple
 
+from module import ccache, history, jobserver, mirror
 from module.args import parse_args
+from module.cache import cross_digest, open_cache, profile_fields
+from module.fetch import limit_extract, validate_and_download
 from module.path import ProjectPaths
-from module.prepare_source import prepare_source
+from module.prepare_source import check_patches, prepare_component, restorable, sources
 from module.profile import BRANCHES
+from module.progress import Progress
+from module.report import BuildReport
+from module.stage import StageGraph
+from module.trace import write_trace
+from module.util import log_to, popen, wait
 
 # A = x86_64-linux-musl
 # B = x86_64-w64-mingw32
@@ -37,24 +47,74 @@ def clean(config: argparse.Namespace, paths: ProjectPaths):
   if not config.no_mingw and paths.mingw_prefix.exists():
     shutil.rmtree(paths.mingw_prefix)
 
+# host libraries and patched sources shared by all branches, and their stamps
+def clean_shared(paths: ProjectPaths):
+  if paths.shared.exists():
+    shutil.rmtree(paths.shared)
+  if paths.src.exists():
+    shutil.rmtree(paths.src)
+
 def prepare_dirs(paths: ProjectPaths):
   paths.assets.mkdir(parents = True, exist_ok = True)
   paths.build.mkdir(parents = True, exist_ok = True)
   paths.dist.mkdir(parents = True, exist_ok = True)
 
+# profile fields are keyed by the stages reading them (see `stage._inputs`),
+# so that e.g. bumping `rev` only reruns the packaging stages
+def fingerprint(config: argparse.Namespace) -> str:
+  return json.dumps({
+    'build': config.build,
+    'no_cross': config.no_cross,
+  }, sort_keys = True)
+
 def _package(root: Path | str, src: Path | str, dst: Path):
-  tar = Popen(['bsdtar', '-C', root, '-c', src], stdout = PIPE)
-  zstd = Popen([
+  tar_step = f'{dst.name} (bsdtar)'
+  zstd_step = f'{dst.name} (zstd)'
+  tar = popen(['bsdtar', '-C', root, '-c', src], step = tar_step, stdout = PIPE)
+  zstd = popen([
     'zstd', '-f',
     '--zstd=strat=5,wlog=27,hlog=25,slog=6',
     '-o', dst,
-  ], stdin = tar.stdout)
+  ], step = zstd_step, stdin = tar.stdout)
   tar.stdout.close()
-  zstd.communicate()
-  tar.wait()
-  if tar.returncode != 0 or zstd.returncode != 0:
+  zstd_code = wait(zstd_step, zstd)
+  tar_code = wait(tar_step, tar)
+  if tar_code != 0 or zstd_code != 0:
     raise Exception('bsdtar | zstd failed')
 
+# mirrors are ranked once for the archives of all branches
+def rank_mirrors(config: argparse.Namespace):
+  mirror.rank([
+    item
+    for branch in config.branches
+    for items in sources(BRANCHES[branch], ProjectPaths(config, BRANCHES[branch])).values()
+    for item in items
+  ], config.mirrors)
+
+def download(config: argparse.Namespace, arx: Path, family: str, path: str):
+  validate_and_download(
+    arx,
+    mirror.urls(family, path),
+    retry = config.download_retry,
+    backoff = config.download_backoff,
+    paranoid = config.paranoid,
+    store = Path(config.asset_store).expanduser() if config.asset_store else None,
+    transcode = config.transcode,
+  )
+
+def download_all(config: argparse.Namespace, items: List[Tuple[Path, str, str]]):
+  for item in items:
+    download(config, *item)
+
+# archives are shared by branches, the first one asking for an archive fetches it
+def fetch(config: argparse.Namespace, graph: StageGraph, deps: List[str], arx: Path, family: str, path: str) -> str:
+  return graph.shared(arx.name, lambda shared: shared.add(
+    'fetch',
+    lambda: download(config, arx, family, path),
+    deps,
+    stamp = False,
+  ))
+
 def package_cross(paths: ProjectPaths):
   _package(paths.x_prefix.parent, paths.x_prefix.name, paths.x_pkg)
 
@@ -65,6 +125,101 @@ def package_linux(paths: ProjectPaths):
 def package_mingw(paths: ProjectPaths):
   _package(paths.mingw_prefix.parent, paths.mingw_prefix.name, paths.mingw_pkg)
 
+def plan(config: argparse.Namespace, graph: StageGraph, multiple: bool) -> BuildReport:
+  logging.info("planning GCC %s", config.branch)
+
+  ver = BRANCHES[config.branch]
+  paths = ProjectPaths(config, ver)
+
+  if config.clean:
+    clean(config, paths)
+
+  prepare_dirs(paths)
+
+  env = {**os.environ, 'PATH': f'{paths.x_prefix}/bin:{os.environ["PATH"]}'}
+  if config.ccache:
+    env = ccache.environ(Path(config.ccache), paths.build_root, paths.build / 'ccache', env)
+
+  # completed stages are stamped, so a rerun resumes where the last one failed
+  graph = graph.scope(
+    prefix = f'[{config.branch}] ' if multiple else '',
+    stamp_dir = paths.build / '.stamp',
+    fingerprint = fingerprint(config),
+    env = env,
+    report = BuildReport(config.branch, paths.dist / f'build-report-{config.branch}.json'),
+  )
+
+  # components are fetched and prepared on first use, so that building starts
+  # as soon as its own sources are ready
+  ranked = graph.shared('mirrors', lambda shared: shared.add('rank', lambda: rank_mirrors(config), stamp = False))
+  archives = sources(ver, paths)
+  prepared: Dict[str, str] = {}
+  def ready(*components: str) -> List[str]:
+    for component in components:
+      if component in archives and component not in prepared:
+        # a snapshot of the patched sources needs no archives, unless it is gone by then
+        restore = restorable(component, ver, paths, graph.cache)
+        if restore:
+          fetched = [ranked]
+        else:
+          fetched = [fetch(config, graph, [ranked], *item) for item in archives[component]]
+        # branches share extracted sources, a tree is prepared by one branch at a time
+        prepared[component] = graph.add(
+          f'prepare {component}',
+          lambda component = component, restore = restore: prepare_component(
+            component, ver, paths, graph.cache, restore,
+            lambda: download_all(config, archives[component]),
+          ),
+          fetched,
+          lock = f'prepare {getattr(paths, component)}',
+          stamp = False,
+        )
+    return [prepared[component] for component in components if component in prepared]
+
+  # without cross build, the cross toolchain in `x_prefix` is used as is
+  aac = {arch: [] for arch in ['x86_64', 'aarch64']}
+  aab = []
+  if not config.no_cross:
+    cross_key = cross_digest(ver, paths, config)
+    # a cached cross toolchain replaces all AA* stages
+    cross = graph.restore('cross', cross_key, paths.x_prefix, [])
+    if cross is not None:
+      aac = {arch: [cross] for arch in ['x86_64', 'aarch64']}
+      aab = [cross]
+    else:
+      # glibc prior to 2.31 can not be built with make 4.4 (infinite recursion)
+      # upstream accidentally fixed it, cherry-pick seems very hard
+      # the workaround is to build everything with make at that time
+      # ref. https://github.com/crosstool-ng/crosstool-ng/issues/1932#issuecomment-1528139734
+      make = build_AAA_make(ver, paths, config, graph, ready('make'))
+      # host libraries may come from another branch, which has its own make
+      library = build_AAA_library(ver, paths, config, graph, [make, *ready('gmp', 'mpfr', 'mpc', 'python')])
+      python = build_AAA_python(ver, paths, config, graph, [make, library, *ready('python')])
+      for arch in ['x86_64', 'aarch64']:
+        compiler = build_AAC_compiler(arch, ver, paths, config, graph, [make, library, *ready('binutils', 'kernel', 'gcc', 'glibc')])
+        aac[arch] = [compiler, build_AAC_library(arch, ver, paths, config, graph, [compiler, *ready('gmp', 'mpfr', 'mpc')])]
+      compiler = build_AAB_compiler(ver, paths, config, graph, [make, library, *ready('binutils', 'mingw', 'gcc')])
+      # python packages are byte-compiled with AAA python
+      aab = [compiler, build_AAB_library(ver, paths, config, graph, [compiler, python, *ready('gmp', 'mpfr', 'mpc', 'iconv', 'gettext', 'python')])]
+      cross = graph.store('cross', cross_key, paths.x_prefix, [*aac['x86_64'], *aac['aarch64'], *aab])
+    graph.add('package cross', lambda: package_cross(paths), [cross])
+
+  # toolchains also ship licenses of all components
+  prepare = graph.add('prepare source', None, ready(*archives))
+
+  linux = []
+  for arch in ['x86_64', 'aarch64']:
+    toolchain = build_ABC_toolchain(arch, ver, paths, config, graph, [*aac[arch][:1], *aab, prepare])
+    linux.append(create_ABC_alias(arch, ver, paths, config, graph, [toolchain]))
+    linux.append(build_ACC_gdbserver(arch, ver, paths, config, graph, [*aac[arch], prepare]))
+  graph.add('package linux', lambda: package_linux(paths), linux)
+
+  if not config.no_mingw:
+    toolchain = build_ABB_toolchain(ver, paths, config, graph, [*aab, prepare])
+    graph.add('package mingw', lambda: package_mingw(paths), [toolchain])
+
+  return graph.report
+
 def main():
   config = parse_args()
 
@@ -75,48 +230,67 @@ def main():
   else:
     logging.basicConfig(level = logging.ERROR)
 
-  logging.info("building GCC %s", config.branch)
+  logging.info("building GCC %s", ', '.join(config.branches))
 
-  ver = BRANCHES[config.branch]
-  paths = ProjectPaths(config, ver)
+  # host-side dependencies of the same versions are built once for all branches,
+  # installed outputs are also cached by input hash, shared by all builds pointing to the same directory or url
+  paths = ProjectPaths(config, BRANCHES[config.branch])
+  history_path = Path(config.history) if config.history else paths.build_root / 'history.sqlite'
 
-  if config.clean:
-    clean(config, paths)
+  if config.analyze:
+    results = [history.analyze(history_path, branch, config.regression_threshold) for branch in config.branches]
+    if not all(results):
+      sys.exit(1)
+    return
 
-  prepare_dirs(paths)
+  if config.check_patches:
+    prepare_dirs(paths)
+    limit_extract(config.extract_jobs)
+    if not check_patches(config):
+      sys.exit(1)
+    return
 
-  prepare_source(ver, paths)
+  # once for all branches, before any of them plans
+  if config.clean_shared:
+    clean_shared(paths)
 
-  # glibc prior to 2.31 can not be built with make 4.4 (infinite recursion)
-  # upstream accidentally fixed it, cherry-pick seems very hard
-  # the workaround is to build everything with make at that time
-  # ref. https://github.com/crosstool-ng/crosstool-ng/issues/1932#issuecomment-1528139734
-  if not config.no_cross:
-    build_AAA_make(ver, paths, config)
+  graph = StageGraph(cache = open_cache(config, paths), shared_stamp_dir = paths.shared / '.stamp')
 
-  os.environ['PATH'] = f'{paths.x_prefix}/bin:{os.environ["PATH"]}'
-  if not config.no_cross:
-    build_AAA_library(ver, paths, config)
-    build_AAA_python(ver, paths, config)
-    build_AAC_compiler('x86_64', ver, paths, config)
-    build_AAC_library('x86_64', ver, paths, config)
-    build_AAC_compiler('aarch64', ver, paths, config)
-    build_AAC_library('aarch64', ver, paths, config)
-    build_AAB_compiler(ver, paths, config)
-    build_AAB_library(ver, paths, config)
-    package_cross(paths)
-
-  build_ABC_toolchain('x86_64', ver, paths, config)
-  create_ABC_alias('x86_64', ver, paths, config)
-  build_ACC_gdbserver('x86_64', ver, paths, config)
-  build_ABC_toolchain('aarch64', ver, paths, config)
-  create_ABC_alias('aarch64', ver, paths, config)
-  build_ACC_gdbserver('aarch64', ver, paths, config)
-  package_linux(paths)
+  reports = []
+  for branch in config.branches:
+    reports.append(plan(argparse.Namespace(**{**vars(config), 'branch': branch}), graph, len(config.branches) > 1))
 
-  if not config.no_mingw:
-    build_ABB_toolchain(ver, paths, config)
-    package_mingw(paths)
+  if config.ccache:
+    stats = ccache.stats(Path(config.ccache))
+
+  progress = None
+  if config.progress:
+    log_dir = paths.build_root / 'log'
+    for branch in config.branches:
+      if (log_dir / branch).exists():
+        shutil.rmtree(log_dir / branch)
+    log_to(log_dir)
+    print(f'Logs of build steps are in {log_dir}', file = sys.stderr)
+    progress = Progress(graph, history.predict(history_path, graph))
+
+  limit_extract(config.extract_jobs)
+
+  # one jobserver for all concurrently running stages
+  jobserver.start(config.jobs)
+  ok = False
+  try:
+    graph.run(config.jobs, progress)
+    ok = True
+  finally:
+    if progress is not None:
+      progress.close()
+    for branch, report in zip(config.branches, reports):
+      report.write()
+      history.record(history_path, graph, report, profile_fields(BRANCHES[branch]), ok)
+    if config.trace:
+      write_trace(reports, Path(config.trace))
+    if config.ccache:
+      print(ccache.summary(stats, ccache.stats(Path(config.ccache))))
 
 if __name__ == '__main__':
   main()
@@ -1,39 +1,58 @@
 import argparse
 import os
+from pathlib import Path
 import shutil
 from packaging.version import Version
+from typing import List
 
+from module.cache import host_identity
 from module.debug import shell_here
 from module.path import ProjectPaths
 from module.profile import BranchProfile
-from module.util import cflags_A, cflags_C, configure, ensure, make_custom, make_default, make_destdir_install, make_install
+from module.stage import StageGraph
+from module.util import cflags_A, cflags_C, configure, digest, ensure, make_custom, make_default, make_destdir_install, make_install
 
-def _gmake(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
+def _gmake_c_extra(ver: BranchProfile) -> List[str]:
   v = Version(ver.make)
   v_gcc = Version(ver.gcc)
-  build_dir = paths.make / 'build-AAA'
-  ensure(build_dir)
-
   c_extra = []
 
   # GCC 15 defaults to C23, in which `foo()` means `foo(void)` instead of `foo(...)`.
   if v_gcc.major >= 15 and v < Version('4.5'):
     c_extra.append('-std=gnu11')
 
+  return c_extra
+
+# e.g. `make-4.4.1-std=gnu11`
+def _gmake_dir(ver: BranchProfile, paths: ProjectPaths) -> Path:
+  return paths.shared / '-'.join(['make', ver.make, *(flag.lstrip('-') for flag in _gmake_c_extra(ver))])
+
+def _gmake(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
+  build_dir = paths.out(paths.make, 'build-AAA')
+  ensure(build_dir)
+
   configure('make', build_dir, [
     '--prefix=',
     f'--build={config.build}',
     '--disable-nls',
-    *cflags_A(c_extra = c_extra, ld_extra = ['-static']),
-  ])
+    *cflags_A(c_extra = _gmake_c_extra(ver), ld_extra = ['-static']),
+  ], src = paths.make)
   make_default('make', build_dir, config.jobs)
-  make_destdir_install('make', build_dir, paths.x_prefix)
+  make_destdir_install('make', build_dir, _gmake_dir(ver, paths))
+
+def _gmake_install(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
+  shutil.copytree(_gmake_dir(ver, paths), paths.x_prefix, dirs_exist_ok = True)
 
-def build_AAA_make(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
-  _gmake(ver, paths, config)
+# built once for all branches using the same make, then copied into `x_prefix`
+def build_AAA_make(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace, graph: StageGraph, deps: List[str]) -> str:
+  make = graph.shared(
+    _gmake_dir(ver, paths).name,
+    lambda shared: shared.add('AAA make', lambda: _gmake(ver, paths, config), deps),
+  )
+  return graph.add('AAA make (install)', lambda: _gmake_install(ver, paths, config), [make])
 
 def _gmp(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
-  build_dir = paths.gmp / 'build-AAA'
+  build_dir = paths.out(paths.gmp, 'build-AAA')
   ensure(build_dir)
   configure('gmp', build_dir, [
     f'--prefix={paths.x_dep}',
@@ -43,12 +62,12 @@ def _gmp(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
     '--enable-static',
     '--disable-shared',
     *cflags_A(),
-  ])
+  ], src = paths.gmp)
   make_default('gmp', build_dir, config.jobs)
   make_install('gmp', build_dir)
 
 def _mpfr(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
-  build_dir = paths.mpfr / 'build-AAA'
+  build_dir = paths.out(paths.mpfr, 'build-AAA')
   ensure(build_dir)
   configure('mpfr', build_dir, [
     f'--prefix={paths.x_dep}',
@@ -60,12 +79,12 @@ def _mpfr(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
       common_extra = [f'-I{paths.x_dep}/include'],
       ld_extra = [f'-L{paths.x_dep}/lib'],
     ),
-  ])
+  ], src = paths.mpfr)
   make_default('mpfr', build_dir, config.jobs)
   make_install('mpfr', build_dir)
 
 def _mpc(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
-  build_dir = paths.mpc / 'build-AAA'
+  build_dir = paths.out(paths.mpc, 'build-AAA')
   ensure(build_dir)
   configure('mpc', build_dir, [
     f'--prefix={paths.x_dep}',
@@ -77,32 +96,51 @@ def _mpc(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
       common_extra = [f'-I{paths.x_dep}/include'],
       ld_extra = [f'-L{paths.x_dep}/lib'],
     ),
-  ])
+  ], src = paths.mpc)
   make_default('mpc', build_dir, config.jobs)
   make_install('mpc', build_dir)
 
 def _python_z(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
-  build_dir = paths.python_z / 'build-AAA'
+  build_dir = paths.out(paths.python_z, 'build-AAA')
   ensure(build_dir)
   configure('zlib for python', build_dir, [
     '--prefix=',
     '--static',
-  ])
+  ], src = paths.python_z)
   make_default('zlib for python', build_dir, config.jobs)
   make_destdir_install('zlib for python', build_dir, paths.x_dep)
 
-def build_AAA_library(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
-  _gmp(ver.gmp, paths, config)
+def _library(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace, graph: StageGraph, deps: List[str]) -> str:
+  gmp = graph.add('AAA gmp', lambda: _gmp(ver, paths, config), deps)
 
-  _mpfr(ver.mpfr, paths, config)
+  mpfr = graph.add('AAA mpfr', lambda: _mpfr(ver, paths, config), [gmp])
 
-  _mpc(ver.mpc, paths, config)
+  mpc = graph.add('AAA mpc', lambda: _mpc(ver, paths, config), [mpfr])
 
+  libraries = [mpc]
   if ver.python:
-    _python_z(ver, paths, config)
+    libraries.append(graph.add('AAA zlib for python', lambda: _python_z(ver, paths, config), deps))
+
+  return graph.add('AAA library (build)', None, libraries)
+
+def build_AAA_library(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace, graph: StageGraph, deps: List[str]) -> str:
+  key = digest(
+    'AAA library',
+    # installed with absolute prefix
+    str(paths.x_dep),
+    ver.gmp, ver.mpfr, ver.mpc, ver.python_z,
+    cflags_A(),
+    host_identity(config.build),
+    Path(__file__),
+  )
+  # shared by all branches using the same versions
+  return graph.shared(
+    paths.x_dep.name,
+    lambda shared: shared.cached('AAA library', key, paths.x_dep, deps, lambda deps: _library(ver, paths, config, shared, deps)),
+  )
 
 def _python(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
-  build_dir = paths.python / 'build-AAA'
+  build_dir = paths.out(paths.python, 'build-AAA')
   ensure(build_dir)
   configure('python', build_dir, [
     f'--prefix={paths.x_prefix}',
@@ -116,10 +154,11 @@ def _python(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace)
     f'ZLIB_CFLAGS=-I{paths.x_dep}/include',
     f'ZLIB_LIBS=-L{paths.x_dep}/lib -lz',
     *cflags_A(ld_extra = ['-static']),
-  ])
+  ], src = paths.python)
   make_custom('python', build_dir, ['LDFLAGS=-static', 'LINKFORSHARED= '], config.jobs)
   make_install('python', build_dir)
 
-def build_AAA_python(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
+def build_AAA_python(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace, graph: StageGraph, deps: List[str]) -> str:
   if ver.python:
-    _python(ver, paths, config)
+    return graph.add('AAA python', lambda: _python(ver, paths, config), deps)
+  return graph.add('AAA python', None, deps)
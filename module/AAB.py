@@ -1,15 +1,17 @@
 import argparse
 from packaging.version import Version
 import shutil
-import subprocess
+from typing import List
 
+from module import jobserver
 from module.debug import shell_here
 from module.path import ProjectPaths
 from module.profile import BranchProfile
-from module.util import cflags_A, cflags_B, configure, ensure, fix_libtool_absolute_reference, make_custom, make_default, make_destdir_install, make_install
+from module.stage import StageGraph
+from module.util import cflags_A, cflags_B, configure, ensure, environ, fix_libtool_absolute_reference, make_custom, make_default, make_destdir_install, make_install, run
 
 def _binutils(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
-  build_dir = paths.binutils / 'build-AAB'
+  build_dir = paths.out(paths.binutils, 'build-AAB')
   ensure(build_dir)
   configure('binutils', build_dir, [
     '--prefix=',
@@ -26,12 +28,12 @@ def _binutils(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespac
     '--disable-nls',
     # libtool eats `-static`
     *cflags_A(ld_extra = ['--static']),
-  ])
+  ], src = paths.binutils)
   make_default('binutils', build_dir, config.jobs)
   make_destdir_install('binutils', build_dir, paths.x_prefix)
 
 def _headers(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
-  build_dir = paths.mingw / 'mingw-w64-headers' / 'build-AAB'
+  build_dir = paths.out(paths.mingw / 'mingw-w64-headers', 'build-AAB')
   ensure(build_dir)
 
   if ver.win32_winnt >= 0x0A00:
@@ -45,13 +47,13 @@ def _headers(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace
     f'--build={config.build}',
     f'--with-default-msvcrt={crt}',
     f'--with-default-win32-winnt=0x{ver.win32_winnt:04X}',
-  ])
+  ], src = paths.mingw / 'mingw-w64-headers')
   make_default('headers', build_dir, config.jobs)
   make_destdir_install('headers', build_dir, paths.x_prefix / 'x86_64-w64-mingw32')
 
-def _gcc(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
+def _gcc_compiler(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
   v = Version(ver.gcc)
-  build_dir = paths.gcc / 'build-AAB'
+  build_dir = paths.out(paths.gcc, 'build-AAB')
   ensure(build_dir)
 
   config_flags = []
@@ -97,18 +99,18 @@ def _gcc(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
       ld_extra = ['--static'],
     ),
     *cflags_B('_FOR_TARGET', ld_extra = ['--static']),
-  ])
+  ], src = paths.gcc)
 
   make_custom('gcc (all-gcc)', build_dir, ['all-gcc'], config.jobs)
   make_custom('gcc (install-gcc)', build_dir, ['install-gcc'], jobs = 1)
-  yield
 
+def _gcc(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
+  build_dir = paths.out(paths.gcc, 'build-AAB')
   make_default('gcc', build_dir, config.jobs)
   make_install('gcc', build_dir)
-  yield
 
 def _crt(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
-  build_dir = paths.mingw / 'mingw-w64-crt' / 'build-AAB'
+  build_dir = paths.out(paths.mingw / 'mingw-w64-crt', 'build-AAB')
   ensure(build_dir)
 
   if ver.win32_winnt >= 0x0A00:
@@ -125,12 +127,12 @@ def _crt(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
     '--enable-lib64',
     '--disable-lib32',
     *cflags_B(),
-  ])
+  ], src = paths.mingw / 'mingw-w64-crt')
   make_default('crt', build_dir, config.jobs)
   make_destdir_install('crt', build_dir, paths.x_prefix / 'x86_64-w64-mingw32')
 
 def _winpthreads(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
-  build_dir = paths.mingw / 'mingw-w64-libraries' / 'winpthreads' / 'build-AAB'
+  build_dir = paths.out(paths.mingw / 'mingw-w64-libraries' / 'winpthreads', 'build-AAB')
   ensure(build_dir)
   configure('winpthreads', build_dir, [
     '--prefix=',
@@ -139,28 +141,27 @@ def _winpthreads(ver: BranchProfile, paths: ProjectPaths, config: argparse.Names
     '--enable-static',
     '--disable-shared',
     *cflags_B(),
-  ])
+  ], src = paths.mingw / 'mingw-w64-libraries' / 'winpthreads')
   make_default('winpthreads', build_dir, config.jobs)
   make_destdir_install('winpthreads', build_dir, paths.x_prefix / 'x86_64-w64-mingw32')
 
-def build_AAB_compiler(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
-  _binutils(ver, paths, config)
+def build_AAB_compiler(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace, graph: StageGraph, deps: List[str]) -> str:
+  binutils = graph.add('AAB binutils', lambda: _binutils(ver, paths, config), deps)
 
-  _headers(ver, paths, config)
+  headers = graph.add('AAB headers', lambda: _headers(ver, paths, config), deps)
 
-  gcc = _gcc(ver, paths, config)
-  gcc.__next__()
+  gcc_compiler = graph.add('AAB gcc (compiler)', lambda: _gcc_compiler(ver, paths, config), [binutils, headers])
 
-  _crt(ver, paths, config)
+  crt = graph.add('AAB crt', lambda: _crt(ver, paths, config), [gcc_compiler])
 
-  _winpthreads(ver, paths, config)
+  winpthreads = graph.add('AAB winpthreads', lambda: _winpthreads(ver, paths, config), [crt])
 
-  gcc.__next__()
+  return graph.add('AAB gcc', lambda: _gcc(ver, paths, config), [winpthreads])
 
 def _gmp(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
   v = Version(ver.gmp)
   v_gcc = Version(ver.gcc)
-  build_dir = paths.gmp / 'build-AAB'
+  build_dir = paths.out(paths.gmp, 'build-AAB')
   ensure(build_dir)
 
   c_extra = []
@@ -183,12 +184,12 @@ def _gmp(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
     # the check passes and thus *-w64-mingw32-gcc is detected as build system compiler.
     # Here we force the build system compiler to be gcc.
     'CC_FOR_BUILD=gcc',
-  ])
+  ], src = paths.gmp)
   make_default('gmp', build_dir, config.jobs)
   make_destdir_install('gmp', build_dir, paths.x_prefix / 'x86_64-w64-mingw32')
 
 def _mpfr(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
-  build_dir = paths.mpfr / 'build-AAB'
+  build_dir = paths.out(paths.mpfr, 'build-AAB')
   ensure(build_dir)
   configure('mpfr', build_dir, [
     '--prefix=',
@@ -197,14 +198,14 @@ def _mpfr(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
     '--enable-static',
     '--disable-shared',
     *cflags_B(),
-  ])
+  ], src = paths.mpfr)
   make_default('mpfr', build_dir, config.jobs)
   make_destdir_install('mpfr', build_dir, paths.x_prefix / 'x86_64-w64-mingw32')
 
   fix_libtool_absolute_reference(paths.x_prefix / 'x86_64-w64-mingw32' / 'lib' / 'libmpfr.la')
 
 def _mpc(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
-  build_dir = paths.mpc / 'build-AAB'
+  build_dir = paths.out(paths.mpc, 'build-AAB')
   ensure(build_dir)
   configure('mpc', build_dir, [
     '--prefix=',
@@ -213,7 +214,7 @@ def _mpc(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
     '--enable-static',
     '--disable-shared',
     *cflags_B(),
-  ])
+  ], src = paths.mpc)
   make_default('mpc', build_dir, config.jobs)
   make_destdir_install('mpc', build_dir, paths.x_prefix / 'x86_64-w64-mingw32')
 
@@ -222,7 +223,7 @@ def _mpc(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
 def _iconv(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
   v = Version(ver.iconv)
   v_gcc = Version(ver.gcc)
-  build_dir = paths.iconv / 'build-AAB'
+  build_dir = paths.out(paths.iconv, 'build-AAB')
   ensure(build_dir)
 
   triplet_args = ['--host=x86_64-w64-mingw32']
@@ -243,12 +244,12 @@ def _iconv(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
     '--enable-static',
     '--disable-shared',
     *cflags_B(c_extra = c_extra),
-  ])
+  ], src = paths.iconv)
   make_default('iconv', build_dir, config.jobs)
   make_destdir_install('iconv', build_dir, paths.x_prefix / 'x86_64-w64-mingw32')
 
 def _gettext(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
-  build_dir = paths.gettext / 'gettext-runtime' / 'build-AAB'
+  build_dir = paths.out(paths.gettext / 'gettext-runtime', 'build-AAB')
   ensure(build_dir)
   configure('gettext', build_dir, [
     '--prefix=',
@@ -257,32 +258,34 @@ def _gettext(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace
     '--enable-static',
     '--disable-shared',
     *cflags_B(),
-  ])
+  ], src = paths.gettext / 'gettext-runtime')
   make_default('gettext', build_dir, config.jobs)
   make_destdir_install('gettext', build_dir, paths.x_prefix / 'x86_64-w64-mingw32')
 
   fix_libtool_absolute_reference(paths.x_prefix / 'x86_64-w64-mingw32' / 'lib' / 'libintl.la')
 
 def _python(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
-  res = subprocess.run([
+  res = run('python (xmake config)', [
     'xmake', 'config', '--root',
     '-p', 'mingw',
     '-a', 'x86_64',
     f'--mingw={paths.x_prefix}',
     f'--cross=x86_64-w64-mingw32-',
-  ], cwd = paths.python)
+  ], cwd = paths.python, env = jobserver.environ(environ()), pass_fds = jobserver.pass_fds())
   if res.returncode != 0:
     raise Exception('xmake config failed')
-  res = subprocess.run([
-    'xmake', 'build', '--root',
-    '-j', str(config.jobs),
-  ], cwd = paths.python)
+  # xmake does not take jobs from the jobserver, reserve them up front
+  with jobserver.slots(config.jobs) as jobs:
+    res = run('python (xmake build)', [
+      'xmake', 'build', '--root',
+      '-j', str(jobs),
+    ], cwd = paths.python, env = jobserver.environ(environ()), pass_fds = jobserver.pass_fds())
   if res.returncode != 0:
     raise Exception('xmake build failed')
-  res = subprocess.run([
+  res = run('python (xmake install)', [
     'xmake', 'install', '--root',
     '-o', paths.x_prefix / 'x86_64-w64-mingw32',
-  ], cwd = paths.python)
+  ], cwd = paths.python, env = jobserver.environ(environ()), pass_fds = jobserver.pass_fds())
   if res.returncode != 0:
     raise Exception('xmake install failed')
 
@@ -291,33 +294,42 @@ def _python_packages(ver: BranchProfile, paths: ProjectPaths, config: argparse.N
   python_lib = x_prefix_mingw / 'Lib'
   python_lib_zip = x_prefix_mingw / 'lib' / 'python.zip'
   shutil.copytree(paths.x_prefix / 'share' / f'gcc-{config.branch}' / 'python', python_lib, dirs_exist_ok = True)
-  subprocess.run([
+  res = run('python packages (compileall)', [
     'python3', '-m', 'compileall',
     '-b',
     '-o', '2',
     '.',
-  ], check = True, cwd = python_lib)
+  ], cwd = python_lib, env = environ())
+  if res.returncode != 0:
+    raise Exception('python compileall failed')
   if python_lib_zip.exists():
     python_lib_zip.unlink()
-  subprocess.run([
+  res = run('python packages (7z)', [
     '7z', 'a', '-tzip',
     '-mx0',  # no compression, reduce final size
     python_lib_zip,
     '*', '-xr!__pycache__', '-xr!*.py',
-  ], check = True, cwd = python_lib)
+  ], cwd = python_lib, env = environ())
+  if res.returncode != 0:
+    raise Exception('python 7z failed')
+
+def build_AAB_library(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace, graph: StageGraph, deps: List[str]) -> str:
+  gmp = graph.add('AAB gmp', lambda: _gmp(ver, paths, config), deps)
 
-def build_AAB_library(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
-  _gmp(ver, paths, config)
+  mpfr = graph.add('AAB mpfr', lambda: _mpfr(ver, paths, config), [gmp])
 
-  _mpfr(ver, paths, config)
+  mpc = graph.add('AAB mpc', lambda: _mpc(ver, paths, config), [mpfr])
 
-  _mpc(ver, paths, config)
+  iconv = graph.add('AAB iconv', lambda: _iconv(ver, paths, config), deps)
 
-  _iconv(ver, paths, config)
+  libraries = [mpc, iconv]
 
   if ver.gettext:
-    _gettext(ver, paths, config)
+    # gettext-runtime picks up libiconv from the sysroot
+    libraries.append(graph.add('AAB gettext', lambda: _gettext(ver, paths, config), [iconv]))
 
   if ver.python:
-    _python(ver, paths, config)
-    _python_packages(ver, paths, config)
+    python = graph.add('AAB python', lambda: _python(ver, paths, config), deps)
+    libraries.append(graph.add('AAB python packages', lambda: _python_packages(ver, paths, config), [python]))
+
+  return graph.add('AAB library', None, libraries)
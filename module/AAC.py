@@ -1,16 +1,20 @@
 import argparse
 import glob
 import os
+from pathlib import Path
 import shutil
 from packaging.version import Version
+from typing import List
 
+from module.cache import host_identity
 from module.debug import shell_here
-from module.path import ProjectPaths
+from module.path import ProjectPaths, source_inputs
 from module.profile import BranchProfile
-from module.util import cflags_A, cflags_C, configure, ensure, fix_limits_h, make_custom, make_default, make_destdir_install, make_install
+from module.stage import StageGraph
+from module.util import cflags_A, cflags_C, configure, digest, ensure, fix_limits_h, make_custom, make_default, make_destdir_install, make_install
 
 def _binutils(arch: str, ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
-  build_dir = paths.binutils / f'build-AAC-{arch}'
+  build_dir = paths.out(paths.binutils, f'build-AAC-{arch}')
   ensure(build_dir)
   configure('binutils', build_dir, [
     f'--prefix=',
@@ -28,7 +32,7 @@ def _binutils(arch: str, ver: BranchProfile, paths: ProjectPaths, config: argpar
     '--disable-nls',
     # libtool eats `-static`
     *cflags_A(ld_extra = ['--static']),
-  ])
+  ], src = paths.binutils)
   make_default('binutils', build_dir, config.jobs)
   make_destdir_install('binutils', build_dir, paths.x_prefix)
 
@@ -40,8 +44,13 @@ def _kernel_headers(arch: str, ver: BranchProfile, paths: ProjectPaths, config:
 
   prefix = paths.x_prefix / f'{arch}-linux-gnu'
 
+  # `headers_install` writes into the kernel source tree unless `O` is given
+  build_dir = paths.out(paths.kernel, f'build-AAC-{arch}')
+  ensure(build_dir)
+
   make_custom('kernel headers', paths.kernel, [
     'headers_install',
+    f'O={build_dir}',
     f'ARCH={KARCH_MAP[arch]}',
     f'INSTALL_HDR_PATH={prefix}',
   ], config.jobs)
@@ -52,23 +61,15 @@ def _kernel_headers(arch: str, ver: BranchProfile, paths: ProjectPaths, config:
   for file in prefix.glob('**/..install.cmd'):
     file.unlink()
 
-def _gcc(arch: str, ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
+def _gcc_compiler(arch: str, ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
   v = Version(ver.gcc)
-  build_dir = paths.gcc / f'build-AAC-{arch}'
+  build_dir = paths.out(paths.gcc, f'build-AAC-{arch}')
   ensure(build_dir)
 
-  libexec_target = paths.x_prefix / 'lib' / 'gcc' / f'{arch}-linux-gnu'
-
   config_flags = []
 
-  if v.major >= 13:
-    config_flags.append('--with-gcc-major-version-only')
-    limits_h = libexec_target / str(v.major) / 'include' / 'limits.h'
-  elif v.major >= 7:
+  if v.major >= 7:
     config_flags.append('--with-gcc-major-version-only')
-    limits_h = libexec_target / str(v.major) / 'include-fixed' / 'limits.h'
-  else:
-    limits_h = libexec_target / ver.gcc / 'include-fixed' / 'limits.h'
 
   configure('gcc', build_dir, [
     f'--prefix={paths.x_prefix}',
@@ -100,28 +101,39 @@ def _gcc(arch: str, ver: BranchProfile, paths: ProjectPaths, config: argparse.Na
     # libtool eats `-static`
     *cflags_A(ld_extra = ['--static']),
     *cflags_C('_FOR_TARGET', ld_extra = ['--static']),
-  ])
+  ], src = paths.gcc)
 
   make_custom('gcc (all-gcc)', build_dir, ['all-gcc'], config.jobs)
   make_custom('gcc (install-gcc)', build_dir, ['install-gcc'], jobs = 1)
-  yield
 
+def _gcc_libgcc(arch: str, ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
+  build_dir = paths.out(paths.gcc, f'build-AAC-{arch}')
   make_custom('gcc (all-target-libgcc)', build_dir, ['all-target-libgcc'], config.jobs)
   make_custom('gcc (install-target-libgcc)', build_dir, ['install-target-libgcc'], jobs = 1)
-  yield
+
+def _gcc(arch: str, ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
+  v = Version(ver.gcc)
+  build_dir = paths.out(paths.gcc, f'build-AAC-{arch}')
+
+  libexec_target = paths.x_prefix / 'lib' / 'gcc' / f'{arch}-linux-gnu'
+
+  if v.major >= 13:
+    limits_h = libexec_target / str(v.major) / 'include' / 'limits.h'
+  elif v.major >= 7:
+    limits_h = libexec_target / str(v.major) / 'include-fixed' / 'limits.h'
+  else:
+    limits_h = libexec_target / ver.gcc / 'include-fixed' / 'limits.h'
 
   make_default('gcc', build_dir, config.jobs)
   make_install('gcc', build_dir)
   fix_limits_h(limits_h, paths.gcc)
-  yield
 
-def _glibc(arch: str, ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
+def _glibc_headers(arch: str, ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
   v = Version(ver.glibc)
-  build_dir = paths.glibc / f'build-AAC-{arch}'
+  build_dir = paths.out(paths.glibc, f'build-AAC-{arch}')
   ensure(build_dir)
 
   prefix = paths.x_prefix / f'{arch}-linux-gnu'
-  destdir = paths.glibc / f'pkg-AAC-{arch}'
 
   config_flags = []
 
@@ -152,12 +164,17 @@ def _glibc(arch: str, ver: BranchProfile, paths: ProjectPaths, config: argparse.
     # disable C++ to avoid -lgcc_s in test links-dso-program
     # which is not supported by static compiler
     'CXX=false',
-  ])
+  ], src = paths.glibc)
 
   make_custom('glibc (install-headers)', build_dir, [f'DESTDIR={prefix}', 'install-headers'], jobs = 1)
   with open(prefix / 'include' / 'gnu' / 'stubs.h', 'w'):
     pass
-  yield
+
+def _glibc(arch: str, ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
+  v = Version(ver.glibc)
+  build_dir = paths.out(paths.glibc, f'build-AAC-{arch}')
+
+  destdir = paths.out(paths.glibc, f'pkg-AAC-{arch}')
 
   make_default('glibc', build_dir, config.jobs)
   make_destdir_install('glibc', build_dir, destdir)
@@ -178,31 +195,47 @@ def _glibc(arch: str, ver: BranchProfile, paths: ProjectPaths, config: argparse.
     with open(f'{destdir}/lib/libm.a', 'w') as f:
       f.write(libm_content.replace('/lib/', './'))
 
+def _glibc_install(arch: str, ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
+  prefix = paths.x_prefix / f'{arch}-linux-gnu'
+  destdir = paths.out(paths.glibc, f'pkg-AAC-{arch}')
+
   # really install
   shutil.copytree(destdir, prefix, dirs_exist_ok = True)
-  yield
 
-def build_AAC_compiler(arch: str, ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
-  _binutils(arch, ver, paths, config)
+def build_AAC_compiler(arch: str, ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace, graph: StageGraph, deps: List[str]) -> str:
+  binutils = graph.add(f'AAC-{arch} binutils', lambda: _binutils(arch, ver, paths, config), deps)
+
+  kernel_headers = graph.add(f'AAC-{arch} kernel headers', lambda: _kernel_headers(arch, ver, paths, config), deps)
 
-  _kernel_headers(arch, ver, paths, config)
+  gcc_compiler = graph.add(f'AAC-{arch} gcc (compiler)', lambda: _gcc_compiler(arch, ver, paths, config), [binutils, kernel_headers])
 
-  gcc = _gcc(arch, ver, paths, config)
-  gcc.__next__()
+  glibc_headers = graph.add(f'AAC-{arch} glibc (headers)', lambda: _glibc_headers(arch, ver, paths, config), [gcc_compiler])
 
-  glibc = _glibc(arch, ver, paths, config)
-  glibc.__next__()
+  gcc_libgcc = graph.add(f'AAC-{arch} gcc (libgcc)', lambda: _gcc_libgcc(arch, ver, paths, config), [glibc_headers])
 
-  gcc.__next__()
+  # built by the stage 1 compiler against the kernel headers
+  glibc_key = digest(
+    f'AAC-{arch} glibc',
+    ver.binutils, ver.gcc, ver.glibc, ver.kernel, ver.enable_kernel(arch),
+    [paths.patch / component for component in ['binutils', 'gcc', 'glibc', 'linux']],
+    [source_inputs(component, ver) for component in ['binutils', 'gcc', 'glibc', 'kernel']],
+    cflags_A(), cflags_C(),
+    host_identity(config.build),
+    Path(__file__),
+  )
+  glibc = graph.cached(
+    f'AAC-{arch} glibc', glibc_key, paths.out(paths.glibc, f'pkg-AAC-{arch}'), [gcc_libgcc],
+    lambda deps: graph.add(f'AAC-{arch} glibc (build)', lambda: _glibc(arch, ver, paths, config), deps),
+  )
 
-  glibc.__next__()
+  glibc_install = graph.add(f'AAC-{arch} glibc (install)', lambda: _glibc_install(arch, ver, paths, config), [glibc])
 
-  gcc.__next__()
+  return graph.add(f'AAC-{arch} gcc', lambda: _gcc(arch, ver, paths, config), [glibc_install])
 
 def _gmp(arch: str, ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
   v = Version(ver.gmp)
   v_gcc = Version(ver.gcc)
-  build_dir = paths.gmp / f'build-AAC-{arch}'
+  build_dir = paths.out(paths.gmp, f'build-AAC-{arch}')
   ensure(build_dir)
 
   c_extra = []
@@ -219,12 +252,12 @@ def _gmp(arch: str, ver: BranchProfile, paths: ProjectPaths, config: argparse.Na
     '--enable-static',
     '--disable-shared',
     *cflags_C(c_extra = c_extra),
-  ])
+  ], src = paths.gmp)
   make_default('gmp', build_dir, config.jobs)
   make_destdir_install('gmp', build_dir, paths.x_prefix / f'{arch}-linux-gnu')
 
 def _mpfr(arch: str, ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
-  build_dir = paths.mpfr / f'build-AAC-{arch}'
+  build_dir = paths.out(paths.mpfr, f'build-AAC-{arch}')
   ensure(build_dir)
   configure('mpfr', build_dir, [
     '--prefix=',
@@ -233,7 +266,7 @@ def _mpfr(arch: str, ver: BranchProfile, paths: ProjectPaths, config: argparse.N
     '--enable-static',
     '--disable-shared',
     *cflags_C(),
-  ])
+  ], src = paths.mpfr)
   make_default('mpfr', build_dir, config.jobs)
   make_destdir_install('mpfr', build_dir, paths.x_prefix / f'{arch}-linux-gnu')
 
@@ -248,7 +281,7 @@ def _mpfr(arch: str, ver: BranchProfile, paths: ProjectPaths, config: argparse.N
         f.write(line)
 
 def _mpc(arch: str, ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
-  build_dir = paths.mpc / f'build-AAC-{arch}'
+  build_dir = paths.out(paths.mpc, f'build-AAC-{arch}')
   ensure(build_dir)
   configure('mpc', build_dir, [
     '--prefix=',
@@ -257,7 +290,7 @@ def _mpc(arch: str, ver: BranchProfile, paths: ProjectPaths, config: argparse.Na
     '--enable-static',
     '--disable-shared',
     *cflags_C(),
-  ])
+  ], src = paths.mpc)
   make_default('mpc', build_dir, config.jobs)
   make_destdir_install('mpc', build_dir, paths.x_prefix / f'{arch}-linux-gnu')
 
@@ -271,9 +304,9 @@ def _mpc(arch: str, ver: BranchProfile, paths: ProjectPaths, config: argparse.Na
       else:
         f.write(line)
 
-def build_AAC_library(arch: str, ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
-  _gmp(arch, ver, paths, config)
+def build_AAC_library(arch: str, ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace, graph: StageGraph, deps: List[str]) -> str:
+  gmp = graph.add(f'AAC-{arch} gmp', lambda: _gmp(arch, ver, paths, config), deps)
 
-  _mpfr(arch, ver, paths, config)
+  mpfr = graph.add(f'AAC-{arch} mpfr', lambda: _mpfr(arch, ver, paths, config), [gmp])
 
-  _mpc(arch, ver, paths, config)
+  return graph.add(f'AAC-{arch} mpc', lambda: _mpc(arch, ver, paths, config), [mpfr])
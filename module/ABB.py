@@ -2,16 +2,17 @@ import argparse
 import json
 import logging
 import shutil
-import subprocess
 from packaging.version import Version
+from typing import List
 
 from module.debug import shell_here
 from module.path import ProjectPaths
 from module.profile import BranchProfile
-from module.util import cflags_A, cflags_B, configure, ensure, make_custom, make_default, make_destdir_install, make_install, make_install, temporary_symlink
+from module.stage import StageGraph
+from module.util import cflags_A, cflags_B, configure, ensure, environ, make_custom, make_default, make_destdir_install, make_install, make_install, run, temporary_symlink
 
 def _binutils(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
-  build_dir = paths.binutils / 'build-ABB'
+  build_dir = paths.out(paths.binutils, 'build-ABB')
   ensure(build_dir)
   configure('binutils', build_dir, [
     '--prefix=',
@@ -26,7 +27,7 @@ def _binutils(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespac
     '--disable-nls',
     # libtool eats `-static`
     *cflags_A(ld_extra = ['--static']),
-  ])
+  ], src = paths.binutils)
   make_default('binutils', build_dir, config.jobs)
   make_custom('binutils (install)', build_dir, [
     f'DESTDIR={paths.mingw_prefix}',
@@ -36,7 +37,7 @@ def _binutils(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespac
   ], jobs = 1)
 
 def _headers(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
-  build_dir = paths.mingw / 'mingw-w64-headers' / 'build-ABB'
+  build_dir = paths.out(paths.mingw / 'mingw-w64-headers', 'build-ABB')
   ensure(build_dir)
 
   if ver.win32_winnt >= 0x0A00:
@@ -50,12 +51,12 @@ def _headers(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace
     f'--build={config.build}',
     f'--with-default-msvcrt={crt}',
     f'--with-default-win32-winnt=0x{ver.win32_winnt:04X}',
-  ])
+  ], src = paths.mingw / 'mingw-w64-headers')
   make_default('headers', build_dir, config.jobs)
   make_destdir_install('headers', build_dir, paths.mingw_prefix)
 
 def _crt(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
-  build_dir = paths.mingw / 'mingw-w64-crt' / 'build-ABB'
+  build_dir = paths.out(paths.mingw / 'mingw-w64-crt', 'build-ABB')
   ensure(build_dir)
 
   if ver.win32_winnt >= 0x0A00:
@@ -72,12 +73,12 @@ def _crt(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
     '--enable-lib64',
     '--disable-lib32',
     *cflags_B(),
-  ])
+  ], src = paths.mingw / 'mingw-w64-crt')
   make_default('crt', build_dir, config.jobs)
   make_destdir_install('crt', build_dir, paths.mingw_prefix)
 
 def _winpthreads(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
-  build_dir = paths.mingw / 'mingw-w64-libraries' / 'winpthreads' / 'build-ABB'
+  build_dir = paths.out(paths.mingw / 'mingw-w64-libraries' / 'winpthreads', 'build-ABB')
   ensure(build_dir)
   configure('winpthreads', build_dir, [
     '--prefix=',
@@ -86,13 +87,13 @@ def _winpthreads(ver: BranchProfile, paths: ProjectPaths, config: argparse.Names
     '--enable-static',
     '--disable-shared',
     *cflags_B(),
-  ])
+  ], src = paths.mingw / 'mingw-w64-libraries' / 'winpthreads')
   make_default('winpthreads', build_dir, config.jobs)
   make_destdir_install('winpthreads', build_dir, paths.mingw_prefix)
 
 def _gcc(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
   v = Version(ver.gcc)
-  build_dir = paths.gcc / 'build-ABB'
+  build_dir = paths.out(paths.gcc, 'build-ABB')
   ensure(build_dir)
   configure('gcc', build_dir, [
     '--prefix=',
@@ -119,7 +120,7 @@ def _gcc(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
     # libtool eats `-static`
     *cflags_B(ld_extra = ['--static']),
     *cflags_B('_FOR_TARGET', ld_extra = ['--static']),
-  ])
+  ], src = paths.gcc)
   if v.major >= 8:
     make_default('gcc', build_dir, config.jobs)
   else:
@@ -130,11 +131,11 @@ def _gcc(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
   # emulate linux experience: add `print.o` to `libstdc++.a`,
   # allowing `<print>` without `-lstdc++exp`
   if 14 <= v.major < 16:
-    res = subprocess.run([
+    res = run('libstdc++ (ar)', [
       'x86_64-w64-mingw32-ar', 'r',
       paths.mingw_prefix / 'lib' / 'libstdc++.a',
       build_dir / 'x86_64-w64-mingw32' / 'libstdc++-v3' / 'src' / 'c++23' / 'print.o',
-    ])
+    ], env = environ())
     if res.returncode != 0:
       message = f'Build fail: libstdc++ ar returned {res.returncode}'
       logging.critical(message)
@@ -143,7 +144,7 @@ def _gcc(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
 def _gdb(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
   v = Version(ver.gdb)
   v_gcc = Version(ver.gcc)
-  build_dir = paths.gdb / 'build-ABB'
+  build_dir = paths.out(paths.gdb, 'build-ABB')
   ensure(build_dir)
 
   python_flags = []
@@ -170,7 +171,7 @@ def _gdb(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
       common_extra = ['-DPDC_WIDE'],
       c_extra = c_extra
     ),
-  ])
+  ], src = paths.gdb)
   make_default('gdb', build_dir, config.jobs)
   make_destdir_install('gdb', build_dir, paths.mingw_prefix)
 
@@ -191,7 +192,7 @@ def _gdb(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
 def _gmake(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
   v = Version(ver.make)
   v_gcc = Version(ver.gcc)
-  build_dir = paths.make / f'build-ABB'
+  build_dir = paths.out(paths.make, f'build-ABB')
   ensure(build_dir)
 
   c_extra = []
@@ -206,7 +207,7 @@ def _gmake(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
     f'--build={config.build}',
     '--disable-nls',
     *cflags_B(c_extra = c_extra),
-  ])
+  ], src = paths.make)
   make_default('make', build_dir, config.jobs)
   shutil.copy(build_dir / 'make.exe', paths.mingw_prefix / 'bin' / 'mingw32-make.exe')
 
@@ -264,19 +265,23 @@ def _licenses(ver: BranchProfile, paths: ProjectPaths):
     ensure(license_dir / 'zlib')
     shutil.copy(paths.python_z / 'LICENSE', license_dir / 'zlib' / 'LICENSE')
 
-def build_ABB_toolchain(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
-  _binutils(ver, paths, config)
+def build_ABB_toolchain(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace, graph: StageGraph, deps: List[str]) -> str:
+  binutils = graph.add('ABB binutils', lambda: _binutils(ver, paths, config), deps)
 
-  _headers(ver, paths, config)
+  headers = graph.add('ABB headers', lambda: _headers(ver, paths, config), deps)
 
-  _crt(ver, paths, config)
+  crt = graph.add('ABB crt', lambda: _crt(ver, paths, config), [headers])
 
-  _winpthreads(ver, paths, config)
+  winpthreads = graph.add('ABB winpthreads', lambda: _winpthreads(ver, paths, config), [crt])
 
-  _gcc(ver, paths, config)
+  # gcc < 8 looks for the native sysroot in `/mingw`, which is linked to the prefix
+  # (one branch at a time)
+  mingw_lock = '/mingw' if Version(ver.gcc).major < 8 else None
+  gcc = graph.add('ABB gcc', lambda: _gcc(ver, paths, config), [winpthreads], lock = mingw_lock)
 
-  _gdb(ver, paths, config)
+  gdb = graph.add('ABB gdb', lambda: _gdb(ver, paths, config), deps)
 
-  _gmake(ver, paths, config)
+  # `bin` is created by binutils
+  gmake = graph.add('ABB make', lambda: _gmake(ver, paths, config), [binutils])
 
-  _licenses(ver, paths)
+  return graph.add('ABB licenses', lambda: _licenses(ver, paths), [binutils, gcc, gdb, gmake])
@@ -4,14 +4,16 @@ import os
 from packaging.version import Version
 import shutil
 import subprocess
+from typing import List
 
 from module.debug import shell_here
 from module.path import ProjectPaths
 from module.profile import BranchProfile
+from module.stage import StageGraph
 from module.util import cflags_B, cflags_C, configure, ensure, fix_limits_h, make_custom, make_default, make_destdir_install
 
 def _binutils(arch: str, ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
-  build_dir = paths.binutils / f'build-ABC-{arch}'
+  build_dir = paths.out(paths.binutils, f'build-ABC-{arch}')
   ensure(build_dir)
   configure('binutils', build_dir, [
     '--prefix=',
@@ -28,7 +30,7 @@ def _binutils(arch: str, ver: BranchProfile, paths: ProjectPaths, config: argpar
     '--disable-nls',
     # libtool eats `-static`
     *cflags_B(ld_extra = ['--static']),
-  ])
+  ], src = paths.binutils)
   make_default('binutils', build_dir, config.jobs)
   make_custom('binutils', build_dir, [f'DESTDIR={paths.linux_prefix(arch)}', 'tooldir=/', 'install'], jobs = 1)
 
@@ -40,8 +42,13 @@ def _kernel_headers(arch: str, ver: BranchProfile, paths: ProjectPaths, config:
 
   prefix = paths.linux_prefix(arch) / f'{arch}-linux-gnu'
 
+  # `headers_install` writes into the kernel source tree unless `O` is given
+  build_dir = paths.out(paths.kernel, f'build-ABC-{arch}')
+  ensure(build_dir)
+
   make_custom('kernel headers', paths.kernel, [
     'headers_install',
+    f'O={build_dir}',
     f'ARCH={KARCH_MAP[arch]}',
     f'INSTALL_HDR_PATH={prefix}',
   ], config.jobs)
@@ -62,11 +69,11 @@ def _kernel_headers(arch: str, ver: BranchProfile, paths: ProjectPaths, config:
 
 def _glibc(arch: str, ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
   v = Version(ver.glibc)
-  build_dir = paths.glibc / f'build-ABC-{arch}'
+  build_dir = paths.out(paths.glibc, f'build-ABC-{arch}')
   ensure(build_dir)
 
   prefix = paths.linux_prefix(arch) / f'{arch}-linux-gnu'
-  destdir = paths.glibc / f'pkg-ABC-{arch}'
+  destdir = paths.out(paths.glibc, f'pkg-ABC-{arch}')
 
   configure('glibc', build_dir, [
     '--prefix=',
@@ -89,7 +96,7 @@ def _glibc(arch: str, ver: BranchProfile, paths: ProjectPaths, config: argparse.
     # disable C++ to avoid -lgcc_s in test links-dso-program
     # which is not supported by static compiler
     'CXX=false',
-  ])
+  ], src = paths.glibc)
   make_default('glibc', build_dir, config.jobs)
   make_destdir_install('glibc', build_dir, destdir)
 
@@ -114,7 +121,7 @@ def _glibc(arch: str, ver: BranchProfile, paths: ProjectPaths, config: argparse.
 
 def _gcc(arch: str, ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
   v = Version(ver.gcc)
-  build_dir = paths.gcc / f'build-ABC-{arch}'
+  build_dir = paths.out(paths.gcc, f'build-ABC-{arch}')
   ensure(build_dir)
 
   prefix = paths.linux_prefix(arch)
@@ -155,7 +162,7 @@ def _gcc(arch: str, ver: BranchProfile, paths: ProjectPaths, config: argparse.Na
     # libtool eats `-static`
     *cflags_B(ld_extra = ['--static']),
     *cflags_C('_FOR_TARGET', ld_extra = ['--static']),
-  ])
+  ], src = paths.gcc)
   make_default('gcc', build_dir, config.jobs)
   make_destdir_install('gcc', build_dir, prefix)
   fix_limits_h(limits_h, paths.gcc)
@@ -163,7 +170,7 @@ def _gcc(arch: str, ver: BranchProfile, paths: ProjectPaths, config: argparse.Na
 def _gdb(arch: str, ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
   v = Version(ver.gdb)
   v_gcc = Version(ver.gcc)
-  build_dir = paths.gdb / f'build-ABC-{arch}'
+  build_dir = paths.out(paths.gdb, f'build-ABC-{arch}')
   ensure(build_dir)
 
   python_flags = []
@@ -197,7 +204,7 @@ def _gdb(arch: str, ver: BranchProfile, paths: ProjectPaths, config: argparse.Na
       c_extra = c_extra,
       ld_extra = ['--static']
     ),
-  ])
+  ], src = paths.gdb)
   make_default('gdb', build_dir, config.jobs)
   make_destdir_install('gdb', build_dir, paths.linux_prefix(arch))
 
@@ -218,7 +225,7 @@ def _gdb(arch: str, ver: BranchProfile, paths: ProjectPaths, config: argparse.Na
 def _gmake(arch: str, ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
   v = Version(ver.make)
   v_gcc = Version(ver.gcc)
-  build_dir = paths.make / f'build-ABC-{arch}'
+  build_dir = paths.out(paths.make, f'build-ABC-{arch}')
   ensure(build_dir)
 
   c_extra = []
@@ -233,7 +240,7 @@ def _gmake(arch: str, ver: BranchProfile, paths: ProjectPaths, config: argparse.
     f'--build={config.build}',
     '--disable-nls',
     *cflags_B(c_extra = c_extra),
-  ])
+  ], src = paths.make)
   make_default('make', build_dir, config.jobs)
   shutil.copy(build_dir / 'make.exe', paths.linux_prefix(arch) / 'bin' / 'mingw32-make.exe')
 
@@ -295,22 +302,7 @@ def _licenses(arch: str, ver: BranchProfile, paths: ProjectPaths):
     ensure(license_dir / 'zlib')
     shutil.copy(paths.python_z / 'LICENSE', license_dir / 'zlib' / 'LICENSE')
 
-def build_ABC_toolchain(arch: str, ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
-  _binutils(arch, ver, paths, config)
-
-  _kernel_headers(arch, ver, paths, config)
-
-  _glibc(arch, ver, paths, config)
-
-  _gcc(arch, ver, paths, config)
-
-  _gdb(arch, ver, paths, config)
-
-  _gmake(arch, ver, paths, config)
-
-  _licenses(arch, ver, paths)
-
-def create_ABC_alias(arch: str, ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
+def _alias(arch: str, ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
   bindir = paths.linux_prefix(arch) / 'bin'
   target_prefix = f'{arch}-linux-gnu-'
   for file in bindir.glob(f'{target_prefix}*'):
@@ -321,3 +313,22 @@ def create_ABC_alias(arch: str, ver: BranchProfile, paths: ProjectPaths, config:
       else:
         unprefixed.unlink()
     os.link(file, unprefixed)
+
+def build_ABC_toolchain(arch: str, ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace, graph: StageGraph, deps: List[str]) -> str:
+  binutils = graph.add(f'ABC-{arch} binutils', lambda: _binutils(arch, ver, paths, config), deps)
+
+  kernel_headers = graph.add(f'ABC-{arch} kernel headers', lambda: _kernel_headers(arch, ver, paths, config), deps)
+
+  glibc = graph.add(f'ABC-{arch} glibc', lambda: _glibc(arch, ver, paths, config), [kernel_headers])
+
+  gcc = graph.add(f'ABC-{arch} gcc', lambda: _gcc(arch, ver, paths, config), [glibc])
+
+  gdb = graph.add(f'ABC-{arch} gdb', lambda: _gdb(arch, ver, paths, config), deps)
+
+  # `bin` is created by binutils
+  gmake = graph.add(f'ABC-{arch} make', lambda: _gmake(arch, ver, paths, config), [binutils])
+
+  return graph.add(f'ABC-{arch} licenses', lambda: _licenses(arch, ver, paths), [binutils, gcc, gdb, gmake])
+
+def create_ABC_alias(arch: str, ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace, graph: StageGraph, deps: List[str]) -> str:
+  return graph.add(f'ABC-{arch} alias', lambda: _alias(arch, ver, paths, config), deps)
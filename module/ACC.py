@@ -2,15 +2,17 @@ import argparse
 import os
 import shutil
 from packaging.version import Version
+from typing import List
 
 from module.debug import shell_here
 from module.path import ProjectPaths
 from module.profile import BranchProfile
+from module.stage import StageGraph
 from module.util import cflags_A, cflags_C, configure, ensure, make_custom, make_default, make_install
 
 def _gdbserver(arch: str, ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
   v = Version(ver.gdb)
-  build_dir = paths.gdb / f'build-ACC-{arch}'
+  build_dir = paths.out(paths.gdb, f'build-ACC-{arch}')
   ensure(build_dir)
 
   configure('gdbserver', build_dir, [
@@ -30,7 +32,7 @@ def _gdbserver(arch: str, ver: BranchProfile, paths: ProjectPaths, config: argpa
     '--with-gdbserver',
     # libtool eats `-static`
     *cflags_C(ld_extra = ['--static']),
-  ])
+  ], src = paths.gdb)
 
   if v.major >= 10:
     make_custom('gdbserver', build_dir, ['all-gdbserver'], config.jobs)
@@ -39,5 +41,5 @@ def _gdbserver(arch: str, ver: BranchProfile, paths: ProjectPaths, config: argpa
     make_custom('gdbserver', build_dir, ['all-gdb'], config.jobs)
     make_custom('gdbserver (install)', build_dir / 'gdb' / 'gdbserver', [f'DESTDIR={paths.linux_prefix(arch)}', 'install-only'], jobs = 1)
 
-def build_ACC_gdbserver(arch: str, ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace):
-  _gdbserver(arch, ver, paths, config)
+def build_ACC_gdbserver(arch: str, ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace, graph: StageGraph, deps: List[str]) -> str:
+  return graph.add(f'ACC-{arch} gdbserver', lambda: _gdbserver(arch, ver, paths, config), deps)
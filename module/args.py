@@ -3,6 +3,10 @@ import os
 import subprocess
 from subprocess import PIPE
 
+from module.fetch import EXTRACT_JOBS
+from module.mirror import MIRRORS
+from module.profile import BRANCHES
+
 def get_gcc_triplet():
   result = subprocess.run(['gcc', '-dumpmachine'], stdout = PIPE, stderr = PIPE)
   if result.returncode != 0:
@@ -11,22 +15,42 @@ def get_gcc_triplet():
 
 def parse_args() -> argparse.Namespace:
   parser = argparse.ArgumentParser()
-  parser.add_argument(
+  branch = parser.add_mutually_exclusive_group(required = True)
+  branch.add_argument(
     '-b', '--branch',
     type = str,
-    choices = [
-      # C++17 era
-      '15', '14', '13', '12', '11',
-      # C++14 era
-      '10', '9', '8', '7', '6',
-      # C++98 era
-      '5', '4.9', '4.8',
-    ],
-    required = True,
-    help = 'GCC branch to build',
+    help = 'GCC branch to build, or comma-separated branches (e.g. `15,14,13`)',
+  )
+  branch.add_argument(
+    '--all',
+    action = 'store_true',
+    help = 'Build all branches',
   )
 
   gcc_triplet = get_gcc_triplet()
+  parser.add_argument(
+    '--analyze',
+    action = 'store_true',
+    help = 'Do not build, compare the latest run of the branches with their history',
+  )
+  parser.add_argument(
+    '--check-patches',
+    action = 'store_true',
+    help = 'Do not build, try the patch plans of the branches on pristine sources',
+  )
+  parser.add_argument(
+    '--history',
+    type = str,
+    default = None,
+    help = 'SQLite database of build timings (default: `history.sqlite` in the build directory)',
+  )
+  parser.add_argument(
+    '--regression-threshold',
+    type = float,
+    default = 0.2,
+    help = 'Relative slowdown over the median of previous runs reported by `--analyze`',
+  )
+
   parser.add_argument(
     '--build',
     type = str,
@@ -35,10 +59,76 @@ def parse_args() -> argparse.Namespace:
     help = 'Build system triplet',
   )
 
+  parser.add_argument(
+    '--cache',
+    type = str,
+    default = None,
+    help = 'Directory of cached stage outputs',
+  )
+  parser.add_argument(
+    '--cache-url',
+    type = str,
+    default = None,
+    help = 'HTTP endpoint of shared stage outputs (see `python3 -m module.cache_server`)',
+  )
+  parser.add_argument(
+    '--ccache',
+    type = str,
+    default = None,
+    help = 'Wrap compilers with ccache, using the given cache directory',
+  )
   parser.add_argument(
     '-c', '--clean',
     action = 'store_true',
-    help = 'Clean build directories',
+    help = 'Clean build directories of the branch',
+  )
+  parser.add_argument(
+    '--clean-shared',
+    action = 'store_true',
+    help = 'Clean outputs shared by all branches (host libraries, patched sources), not while another build is running',
+  )
+  parser.add_argument(
+    '--download-retry',
+    type = int,
+    default = 5,
+    help = 'Attempts of each download, broken downloads are resumed',
+  )
+  parser.add_argument(
+    '--download-backoff',
+    type = float,
+    default = 2.0,
+    help = 'Seconds before retrying a download, doubled on every retry',
+  )
+  parser.add_argument(
+    '--asset-store',
+    type = str,
+    nargs = '?',
+    const = '~/.cache/competitive-cross-gcc',
+    default = None,
+    help = 'Share source archives with other checkouts through a content-addressed store (default: %(const)s)',
+  )
+  parser.add_argument(
+    '--transcode',
+    action = 'store_true',
+    help = 'Extract xz, bz2, gz and lz archives from zstd copies, kept in the asset store (or assets/.zstd)',
+  )
+  parser.add_argument(
+    '--paranoid',
+    action = 'store_true',
+    help = 'Verify checksums of all archives, even if unchanged since the last verification',
+  )
+  parser.add_argument(
+    '--mirror',
+    type = str,
+    action = 'append',
+    default = [],
+    help = f'Preferred mirror of a source family, `<family>=<url>` (families: {", ".join(MIRRORS)})',
+  )
+  parser.add_argument(
+    '--extract-jobs',
+    type = int,
+    default = EXTRACT_JOBS,
+    help = 'Archives extracted at the same time',
   )
   parser.add_argument(
     '-j', '--jobs',
@@ -55,6 +145,17 @@ def parse_args() -> argparse.Namespace:
     action = 'store_true',
     help = 'Do not build mingw toolchain',
   )
+  parser.add_argument(
+    '--progress',
+    action = 'store_true',
+    help = 'Show progress and ETA, write output of build steps to log files',
+  )
+  parser.add_argument(
+    '--trace',
+    type = str,
+    default = None,
+    help = 'Write a chrome trace of stages and their subprocesses to the given file',
+  )
   parser.add_argument(
     '-v', '--verbose',
     action = 'count',
@@ -63,4 +164,21 @@ def parse_args() -> argparse.Namespace:
   )
 
   result = parser.parse_args()
+
+  if result.all:
+    result.branches = list(BRANCHES.keys())
+  else:
+    result.branches = list(dict.fromkeys(result.branch.split(',')))
+    for branch in result.branches:
+      if branch not in BRANCHES:
+        parser.error(f'invalid branch: {branch} (choose from {", ".join(BRANCHES.keys())})')
+  result.branch = result.branches[0]
+
+  result.mirrors = {}
+  for mirror in result.mirror:
+    family, _, url = mirror.partition('=')
+    if family not in MIRRORS or not url:
+      parser.error(f'invalid mirror: {mirror} (expected `<family>=<url>`, families: {", ".join(MIRRORS)})')
+    result.mirrors.setdefault(family, []).append(url.rstrip('/'))
+
   return result
@@ -0,0 +1,177 @@
+import argparse
+from functools import lru_cache
+import json
+import logging
+import os
+from pathlib import Path
+import shutil
+import subprocess
+from subprocess import PIPE
+from typing import Iterable, Optional
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+from module.decompress import extract
+from module.path import ProjectPaths, source_inputs
+from module.profile import BranchProfile
+from module.util import cflags_A, cflags_B, cflags_C, digest, popen, timed, wait
+
+MODULE_DIR = Path(__file__).parent
+
+# seconds without progress of a request to the remote cache
+REMOTE_TIMEOUT = 20
+
+def archive_name(key: str) -> str:
+  return f'{key[:2]}/{key}.tar.zst'
+
+# remote store shared by build nodes, plain HTTP:
+#   HEAD / GET / PUT <url>/<key[:2]>/<key>.tar.zst
+# see `module.cache_server` for a minimal server.
+# the remote is best effort, failures fall back to building locally.
+# after a failed lookup, the remote is considered unreachable for the rest of the run.
+class HttpBackend:
+  url: str
+  reachable: bool
+
+  def __init__(self, url: str):
+    self.url = url.rstrip('/')
+    self.reachable = True
+
+  def _url(self, key: str) -> str:
+    return f'{self.url}/{archive_name(key)}'
+
+  def contains(self, key: str) -> bool:
+    if not self.reachable:
+      return False
+    try:
+      with urlopen(Request(self._url(key), method = 'HEAD'), timeout = REMOTE_TIMEOUT) as response:
+        return response.status == 200
+    except HTTPError as e:
+      if e.code != 404:
+        logging.warning('Cache remote fail: HEAD %s returned %d', key, e.code)
+      return False
+    # `URLError` and timeouts
+    except OSError as e:
+      logging.warning('Cache remote fail: %s, not used for the rest of the run', getattr(e, 'reason', e))
+      self.reachable = False
+      return False
+
+  def get(self, key: str, archive: Path):
+    partial = archive.with_name(f'{archive.name}.{os.getpid()}.part')
+    try:
+      with timed(f'{archive.name} (cache download)', 'download'), urlopen(self._url(key), timeout = REMOTE_TIMEOUT) as response, open(partial, 'wb') as f:
+        shutil.copyfileobj(response, f)
+    except OSError as e:
+      partial.unlink(missing_ok = True)
+      message = 'Cache fail: downloading %s: %s' % (key, e)
+      logging.critical(message)
+      raise Exception(message)
+    partial.rename(archive)
+
+  def put(self, key: str, archive: Path):
+    with open(archive, 'rb') as f:
+      request = Request(self._url(key), data = f, method = 'PUT', headers = {
+        'Content-Length': str(archive.stat().st_size),
+        'Content-Type': 'application/zstd',
+      })
+      try:
+        with timed(f'{archive.name} (cache upload)', 'upload'), urlopen(request, timeout = REMOTE_TIMEOUT):
+          pass
+      except OSError as e:
+        logging.warning('Cache remote fail: uploading %s: %s', key, e)
+        return
+    logging.info('Cache upload: %s', key)
+
+# content-addressed store of stage outputs:
+#   <root>/<key[:2]>/<key>.tar.zst
+# where the key hashes everything the output depends on (see `digest`).
+# with a remote, misses are looked up remotely and new entries are uploaded.
+class StageCache:
+  root: Path
+  remote: Optional[HttpBackend]
+
+  def __init__(self, root: Path, remote: Optional[HttpBackend] = None):
+    self.root = root
+    self.remote = remote
+
+  def _archive(self, key: str) -> Path:
+    return self.root / archive_name(key)
+
+  def contains(self, key: str) -> bool:
+    if self._archive(key).exists():
+      return True
+    return self.remote is not None and self.remote.contains(key)
+
+  def restore(self, key: str, output: Path):
+    archive = self._archive(key)
+    if not archive.exists():
+      if self.remote is None:
+        message = 'Cache fail: %s is not in the cache' % key
+        logging.critical(message)
+        raise Exception(message)
+      logging.info('Cache download: %s', key)
+      archive.parent.mkdir(parents = True, exist_ok = True)
+      self.remote.get(key, archive)
+    logging.info('Cache hit: restoring %s from %s', output, key)
+    if output.exists():
+      shutil.rmtree(output)
+    output.mkdir(parents = True)
+    returncode = extract(f'{output.name} (cache restore)', archive, output, ['--no-same-owner'])
+    if returncode != 0:
+      message = 'Cache fail: returned %d restoring %s' % (returncode, output)
+      logging.critical(message)
+      raise Exception(message)
+
+  def store(self, key: str, output: Path):
+    archive = self._archive(key)
+    archive.parent.mkdir(parents = True, exist_ok = True)
+    partial = archive.with_name(f'{archive.name}.{os.getpid()}.part')
+    tar_step = f'{output.name} (cache store bsdtar)'
+    zstd_step = f'{output.name} (cache store zstd)'
+    tar = popen(['bsdtar', '-C', output, '-c', '.'], step = tar_step, stdout = PIPE)
+    zstd = popen(['zstd', '-q', '-f', '-T0', '-o', partial], step = zstd_step, stdin = tar.stdout)
+    tar.stdout.close()
+    zstd_code = wait(zstd_step, zstd)
+    tar_code = wait(tar_step, tar)
+    if tar_code != 0 or zstd_code != 0:
+      partial.unlink(missing_ok = True)
+      message = 'Cache fail: bsdtar | zstd failed storing %s' % output
+      logging.critical(message)
+      raise Exception(message)
+    partial.rename(archive)
+    logging.info('Cache store: %s as %s', output, key)
+    if self.remote is not None:
+      self.remote.put(key, archive)
+
+def open_cache(config: argparse.Namespace, paths: ProjectPaths) -> Optional[StageCache]:
+  remote = HttpBackend(config.cache_url) if config.cache_url else None
+  if config.cache:
+    return StageCache(Path(config.cache), remote)
+  if remote is not None:
+    return StageCache(paths.build_root / 'cache', remote)
+  return None
+
+@lru_cache
+def host_identity(build: str) -> str:
+  res = subprocess.run(['gcc', '--version'], stdout = PIPE, stderr = PIPE)
+  return f'{build}\n{res.stdout.decode()}'
+
+def profile_fields(ver: BranchProfile, exclude: Iterable[str] = []) -> str:
+  fields = {key: value for key, value in vars(ver).items() if key not in exclude and not callable(value)}
+  fields['enable_kernel'] = {arch: ver.enable_kernel(arch) for arch in ['x86_64', 'aarch64']}
+  return json.dumps(fields, sort_keys = True)
+
+# everything that ends up in `x_prefix`. gdb is only built by ABB/ABC/ACC,
+# and `rev` only names the packages.
+def cross_digest(ver: BranchProfile, paths: ProjectPaths, config: argparse.Namespace) -> str:
+  return digest(
+    'cross',
+    # installed with absolute prefix
+    str(paths.x_prefix),
+    profile_fields(ver, exclude = ['gdb', 'rev']),
+    [paths.patch / component for component in ['binutils', 'gcc', 'glibc', 'linux', 'make', 'python']],
+    [source_inputs(component, ver) for component in ['binutils', 'gcc', 'glibc', 'kernel', 'make', 'python']],
+    cflags_A(), cflags_B(), cflags_C(),
+    host_identity(config.build),
+    [MODULE_DIR / file for file in ['AAA.py', 'AAB.py', 'AAC.py', 'prepare_source.py']],
+  )
@@ -0,0 +1,119 @@
+#!/usr/bin/python3
+
+# minimal stage cache server for `--cache-url`, e.g.
+#   python3 -m module.cache_server -d /srv/cache -p 8080
+# entries are immutable, a PUT of an existing key is accepted and discarded.
+
+import argparse
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+import os
+from pathlib import Path
+import re
+import shutil
+import threading
+
+ARCHIVE_PATTERN = re.compile(r'^/([0-9a-f]{2})/\1[0-9a-f]{62}\.tar\.zst$')
+
+class CacheHandler(BaseHTTPRequestHandler):
+  root: Path
+
+  def _archive(self) -> Path | None:
+    if not ARCHIVE_PATTERN.match(self.path):
+      self.send_error(HTTPStatus.BAD_REQUEST)
+      return None
+    return self.root / self.path.lstrip('/')
+
+  def _head(self) -> Path | None:
+    archive = self._archive()
+    if archive is None:
+      return None
+    if not archive.exists():
+      self.send_error(HTTPStatus.NOT_FOUND)
+      return None
+    self.send_response(HTTPStatus.OK)
+    self.send_header('Content-Type', 'application/zstd')
+    self.send_header('Content-Length', str(archive.stat().st_size))
+    self.end_headers()
+    return archive
+
+  def do_HEAD(self):
+    self._head()
+
+  def do_GET(self):
+    archive = self._head()
+    if archive is None:
+      return
+    with open(archive, 'rb') as f:
+      shutil.copyfileobj(f, self.wfile)
+
+  def do_PUT(self):
+    archive = self._archive()
+    if archive is None:
+      return
+    length = self.headers.get('Content-Length')
+    if length is None:
+      self.send_error(HTTPStatus.LENGTH_REQUIRED)
+      return
+    remaining = int(length)
+
+    archive.parent.mkdir(parents = True, exist_ok = True)
+    partial = archive.with_name(f'{archive.name}.{os.getpid()}.{threading.get_ident()}.part')
+    with open(partial, 'wb') as f:
+      while remaining > 0:
+        chunk = self.rfile.read(min(remaining, 1 << 20))
+        if not chunk:
+          break
+        f.write(chunk)
+        remaining -= len(chunk)
+    if remaining > 0:
+      partial.unlink()
+      self.send_error(HTTPStatus.BAD_REQUEST, 'Incomplete body')
+      return
+
+    if archive.exists():
+      partial.unlink()
+      self.send_response(HTTPStatus.OK)
+    else:
+      partial.rename(archive)
+      self.send_response(HTTPStatus.CREATED)
+    self.send_header('Content-Length', '0')
+    self.end_headers()
+
+  def log_message(self, format: str, *args):
+    logging.info('%s %s', self.address_string(), format % args)
+
+def parse_args() -> argparse.Namespace:
+  parser = argparse.ArgumentParser()
+  parser.add_argument(
+    '-d', '--directory',
+    type = str,
+    required = True,
+    help = 'Directory of cached stage outputs',
+  )
+  parser.add_argument(
+    '-b', '--bind',
+    type = str,
+    default = '0.0.0.0',
+  )
+  parser.add_argument(
+    '-p', '--port',
+    type = int,
+    default = 8080,
+  )
+  return parser.parse_args()
+
+def main():
+  config = parse_args()
+  logging.basicConfig(level = logging.INFO)
+
+  CacheHandler.root = Path(config.directory)
+  CacheHandler.root.mkdir(parents = True, exist_ok = True)
+
+  server = ThreadingHTTPServer((config.bind, config.port), CacheHandler)
+  logging.info('Serving %s on %s:%d', config.directory, config.bind, config.port)
+  server.serve_forever()
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,88 @@
+import logging
+import os
+from pathlib import Path
+import shutil
+import subprocess
+from subprocess import PIPE
+from typing import Dict, Set
+
+# `--ccache`: compilers are wrapped by ccache's "masquerade" mode, i.e. a
+# directory of symlinks named after the compilers in front of `PATH`.
+# it covers the build compiler, the cross compilers in `x_prefix` and the
+# `*_FOR_TARGET` compilers of canadian builds, all looked up from `PATH`.
+
+TRIPLETS = ['x86_64-w64-mingw32', 'x86_64-linux-gnu', 'aarch64-linux-gnu']
+COMPILERS = [
+  'cc', 'c++', 'gcc', 'g++',
+  *(f'{triplet}-{compiler}' for triplet in TRIPLETS for compiler in ['gcc', 'g++']),
+]
+
+_masquerades: Set[str] = set()
+
+# a rebuilt compiler may keep its driver byte-identical while `cc1` and `cc1plus` change,
+# so ccache hashes all of them (missing ones, e.g. `cc1plus` of a C-only compiler, by the error)
+COMPILER_CHECK = 'compiler-check.sh'
+COMPILER_CHECK_SCRIPT = '''#!/bin/sh
+exec sha256sum "$1" "$("$1" -print-prog-name=cc1)" "$("$1" -print-prog-name=cc1plus)"
+'''
+
+def environ(cache_dir: Path, base_dir: Path, masquerade_dir: Path, env: Dict[str, str]) -> Dict[str, str]:
+  if shutil.which('ccache') is None:
+    message = 'Ccache fail: ccache not found'
+    logging.critical(message)
+    raise Exception(message)
+  masquerade_dir.mkdir(parents = True, exist_ok = True)
+  _masquerades.add(str(masquerade_dir))
+  compiler_check = masquerade_dir / COMPILER_CHECK
+  compiler_check.write_text(COMPILER_CHECK_SCRIPT)
+  compiler_check.chmod(0o755)
+  return {
+    **env,
+    'PATH': f'{masquerade_dir}:{env["PATH"]}',
+    'CCACHE_DIR': str(cache_dir),
+    # paths below `base_dir` are hashed relative to the working directory,
+    # so hits survive wiping the build directory and are shared by branches
+    'CCACHE_BASEDIR': str(base_dir),
+    'CCACHE_NOHASHDIR': '1',
+    # compilers are checked by content rather than mtime, `--clean` rebuilds the cross compilers (see `COMPILER_CHECK`)
+    'CCACHE_COMPILERCHECK': f'{compiler_check} %compiler%',
+  }
+
+# a wrapper must not exist before its compiler, otherwise configure picks it up
+# (e.g. `x86_64-w64-mingw32-gcc` as `CC_FOR_TARGET` while building that very compiler).
+# wrappers are added at stage start as compilers get installed.
+def masquerade(env: Dict[str, str]):
+  masquerade_dir, path = env['PATH'].split(os.pathsep, 1)
+  if masquerade_dir not in _masquerades:
+    return
+  ccache = shutil.which('ccache', path = path)
+  for compiler in COMPILERS:
+    wrapper = Path(masquerade_dir) / compiler
+    if wrapper.is_symlink() or shutil.which(compiler, path = path) is None:
+      continue
+    try:
+      wrapper.symlink_to(ccache)
+    except FileExistsError:
+      pass
+
+def stats(cache_dir: Path) -> Dict[str, int]:
+  res = subprocess.run(
+    ['ccache', '--print-stats'],
+    stdout = PIPE,
+    env = {**os.environ, 'CCACHE_DIR': str(cache_dir)},
+  )
+  result = {}
+  for line in res.stdout.decode().splitlines():
+    key, _, value = line.partition('\t')
+    if value.isdigit():
+      result[key] = int(value)
+  return result
+
+def summary(before: Dict[str, int], after: Dict[str, int]) -> str:
+  delta = lambda key: after.get(key, 0) - before.get(key, 0)
+  direct = delta('direct_cache_hit')
+  preprocessed = delta('preprocessed_cache_hit')
+  miss = delta('cache_miss')
+  total = direct + preprocessed + miss
+  rate = 100 * (direct + preprocessed) / total if total else 0
+  return f'ccache: {direct + preprocessed} hits ({direct} direct, {preprocessed} preprocessed), {miss} misses, {rate:.1f}% hit rate'
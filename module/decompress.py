@@ -0,0 +1,128 @@
+#!/usr/bin/python3
+
+# archives are decoded by a multi-threaded decompressor piped into bsdtar, if one is installed;
+# otherwise bsdtar decodes them itself. compare the decoders on this machine with
+#   python3 -m module.decompress assets/*.tar.*
+
+import argparse
+from functools import cache
+import logging
+from pathlib import Path
+import shutil
+from subprocess import DEVNULL, PIPE
+import time
+from typing import Dict, List, Optional
+
+from module.util import popen, wait
+
+# parallel decoders by archive suffix, in order of preference.
+# xz decodes multi-block archives in parallel since 5.4, older versions ignore `-T0`.
+# zstd decodes on a single thread, bsdtar's libzstd is as fast.
+DECODERS: Dict[str, List[List[str]]] = {
+  '.bz2': [['lbzip2', '-d', '-c'], ['pbzip2', '-d', '-c']],
+  '.gz': [['pigz', '-d', '-c']],
+  '.lz': [['plzip', '-d', '-c']],
+  '.xz': [['xz', '-d', '-c', '-T0']],
+}
+
+# single-threaded decoders, for reference in the benchmark
+REFERENCE: Dict[str, List[List[str]]] = {
+  '.bz2': [['bzip2', '-d', '-c']],
+  '.gz': [['gzip', '-d', '-c']],
+  '.lz': [['lzip', '-d', '-c']],
+  '.xz': [['xz', '-d', '-c', '-T1']],
+  '.zst': [['zstd', '-d', '-c', '-q']],
+}
+
+@cache
+def decoder(suffix: str) -> Optional[List[str]]:
+  for command in DECODERS.get(suffix, []):
+    if shutil.which(command[0]):
+      return command
+  return None
+
+# extracts `arx` into `cwd` with extra bsdtar `args`, returns the first failing return code or 0
+def extract(step: str, arx: Path, cwd: Path, args: List[str]) -> int:
+  command = decoder(arx.suffix)
+  if command is None:
+    return wait(step, popen(['bsdtar', '-xf', arx, *args], step = step, cwd = cwd))
+
+  # bsdtar is started first and outlives the decoder, so the decoder's step nests in it
+  decode_step = f'{step}: {command[0]}'
+  tar = popen(['bsdtar', '-xf', '-', *args], step = step, stdin = PIPE, cwd = cwd)
+  decode = popen([*command, arx], step = decode_step, stdout = tar.stdin)
+  tar.stdin.close()
+  decode_code = wait(decode_step, decode)
+  tar_code = wait(step, tar)
+  return decode_code or tar_code
+
+# zstd twins of source archives (see `fetch.validate_and_download`), decoded by bsdtar's libzstd.
+# a 128 MiB window is the most decoders accept without `--long` of their own.
+TRANSCODE_ARGS = ['-q', '-f', '-T0', '-12', '--long=27']
+
+# recompresses `arx` to `output`, returns the first failing return code or 0
+def transcode(step: str, arx: Path, output: Path) -> int:
+  command = decoder(arx.suffix)
+  if command is None:
+    command = next((command for command in REFERENCE.get(arx.suffix, []) if shutil.which(command[0])), None)
+  if command is None:
+    logging.warning('Transcode fail: no decoder of %s installed', arx.suffix)
+    return 127
+
+  decode_step = f'{step}: {command[0]}'
+  zstd = popen(['zstd', *TRANSCODE_ARGS, '-o', output], step = step, stdin = PIPE)
+  decode = popen([*command, arx], step = decode_step, stdout = zstd.stdin)
+  zstd.stdin.close()
+  decode_code = wait(decode_step, decode)
+  zstd_code = wait(step, zstd)
+  return decode_code or zstd_code
+
+def _bench(arx: Path, args: List[str], repeat: int) -> Optional[float]:
+  best = None
+  for _ in range(repeat):
+    start = time.time()
+    process = popen(args, stdout = DEVNULL, stderr = DEVNULL)
+    if wait(args[0], process) != 0:
+      return None
+    elapsed = time.time() - start
+    best = elapsed if best is None else min(best, elapsed)
+  return best
+
+def parse_args() -> argparse.Namespace:
+  parser = argparse.ArgumentParser()
+  parser.add_argument(
+    'archives',
+    type = str,
+    nargs = '+',
+    help = 'Source archives to decode',
+  )
+  parser.add_argument(
+    '-r', '--repeat',
+    type = int,
+    default = 3,
+    help = 'Runs of each decoder, the fastest counts',
+  )
+  return parser.parse_args()
+
+def main():
+  config = parse_args()
+
+  for arx in map(Path, config.archives):
+    candidates = [['bsdtar', '-xOf']]
+    for command in DECODERS.get(arx.suffix, []) + REFERENCE.get(arx.suffix, []):
+      if shutil.which(command[0]):
+        candidates.append(command)
+    chosen = decoder(arx.suffix) or ['bsdtar', '-xOf']
+
+    size = arx.stat().st_size
+    print(f'{arx.name} ({size / (1 << 20):.1f} MiB)')
+    for command in candidates:
+      elapsed = _bench(arx, [*command, arx], config.repeat)
+      mark = '*' if command == chosen else ' '
+      if elapsed is None:
+        print(f'  {mark} {" ".join(command):24} failed')
+      else:
+        print(f'  {mark} {" ".join(command):24} {elapsed:7.2f}s {size / elapsed / (1 << 20):8.1f} MiB/s')
+
+if __name__ == '__main__':
+  main()
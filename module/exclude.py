@@ -0,0 +1,135 @@
+import ast
+from fnmatch import fnmatchcase
+from functools import lru_cache
+import logging
+import os
+from packaging.version import Version
+from pathlib import Path, PurePosixPath
+from typing import Callable, Dict, Iterator, List
+
+from module.patches import targets
+from module.profile import BranchProfile
+
+# exclusion manifests: trees of source archives that no build step reads (testsuites, documentation),
+# skipped at extraction. entries are paths relative to the source tree, `*` matches within a component.
+#
+# an exclusion is checked to be unused by
+# - paths of the source tree referenced by the build steps (e.g. license files),
+# - files configured by the component's `configure` scripts,
+# - patches applied to the component.
+
+def _binutils(ver: BranchProfile) -> List[str]:
+  return [
+    'binutils/testsuite',
+    'gas/testsuite',
+    'ld/testsuite',
+  ]
+
+def _gcc(ver: BranchProfile) -> List[str]:
+  v = Version(ver.gcc)
+  # `testsuite/Makefile.in` is configured by libstdc++, keep it
+  result = ['libstdc++-v3/testsuite/*_*']
+  # backports for gcc 9 and 10 also patch a test
+  if v.major not in [9, 10]:
+    result.append('gcc/testsuite')
+  return result
+
+def _gdb(ver: BranchProfile) -> List[str]:
+  return [
+    'gdb/testsuite',
+  ]
+
+# the kernel is only used for `headers_install`
+# - `tools/include` is used by x86 `relocs`, built along with the headers
+# - `include/sound` and `include/net` are below `include`, not excluded
+def _kernel(ver: BranchProfile) -> List[str]:
+  return [
+    'Documentation',
+    'drivers',
+    'fs',
+    'net',
+    'samples',
+    'sound',
+  ]
+
+EXCLUDES: Dict[str, Callable[[BranchProfile], List[str]]] = {
+  'binutils': _binutils,
+  'gcc': _gcc,
+  'gdb': _gdb,
+  'kernel': _kernel,
+}
+
+# exclusions of extracted source trees, for `check_tree` and `check_patch`
+_trees: Dict[Path, List[str]] = {}
+
+def excluded(relative: PurePosixPath, entries: List[str]) -> bool:
+  for entry in entries:
+    pattern = PurePosixPath(entry).parts
+    if len(relative.parts) >= len(pattern) and all(fnmatchcase(a, b) for a, b in zip(relative.parts, pattern)):
+      return True
+  return False
+
+# literal paths below `paths.<component>` in the build steps, e.g. `paths.kernel / 'LICENSES' / 'preferred'`
+@lru_cache
+def _references(component: str) -> List[PurePosixPath]:
+  result = []
+  for file in sorted(Path(__file__).parent.glob('*.py')):
+    for node in ast.walk(ast.parse(file.read_text(), str(file))):
+      parts = []
+      while isinstance(node, ast.BinOp) and isinstance(node.op, ast.Div) and \
+        isinstance(node.right, ast.Constant) and isinstance(node.right.value, str):
+        parts.insert(0, node.right.value)
+        node = node.left
+      if parts and isinstance(node, ast.Attribute) and node.attr == component:
+        result.append(PurePosixPath(*parts))
+  return result
+
+# exclusions of `component`, checked against the build steps; `path` is the source tree
+def manifest(component: str, ver: BranchProfile, path: Path) -> List[str]:
+  entries = EXCLUDES[component](ver) if component in EXCLUDES else []
+  for reference in _references(component):
+    if excluded(reference, entries):
+      message = 'Exclude fail: %s/%s is used by the build but excluded (see module/exclude.py)' % (component, reference)
+      logging.critical(message)
+      raise Exception(message)
+  _trees[path] = entries
+  return entries
+
+def _configured(configure: Path) -> Iterator[str]:
+  for line in open(configure, errors = 'replace'):
+    if not line.startswith('ac_config_files="$ac_config_files '):
+      continue
+    for item in line.strip().removeprefix('ac_config_files="$ac_config_files ').rstrip('"').split():
+      # computed by configure, e.g. `$all_outputs` of gcc
+      if '$' in item or '`' in item:
+        continue
+      output, *inputs = item.split(':')
+      yield from inputs or [f'{output}.in']
+
+# files configured by `configure` scripts of the extracted tree are not excluded
+def check_tree(path: Path):
+  entries = _trees.get(path, [])
+  if not entries:
+    return
+  for root, dirs, files in os.walk(path):
+    if 'configure' not in files:
+      continue
+    base = Path(root).relative_to(path)
+    for input in _configured(Path(root) / 'configure'):
+      relative = PurePosixPath(base, input)
+      if excluded(relative, entries):
+        message = 'Exclude fail: %s is configured by %s but excluded (see module/exclude.py)' % (relative, base / 'configure')
+        logging.critical(message)
+        raise Exception(message)
+
+# files changed by `patch` are not excluded
+def check_patch(path: Path, patch: Path):
+  entries = _trees.get(path, [])
+  if not entries:
+    return
+  for pair in targets(patch):
+    for relative in pair:
+      if relative is not None and excluded(relative, entries):
+        message = 'Exclude fail: %s patches %s but it is excluded (see module/exclude.py)' % (patch.name, relative)
+        logging.critical(message)
+        raise Exception(message)
@@ -1,48 +1,443 @@
+from contextlib import contextmanager
+import fcntl
 from hashlib import sha256
+from http.client import HTTPConnection, HTTPException, HTTPResponse, HTTPSConnection, IncompleteRead
+import json
 import logging
+import os
 from pathlib import Path
-import subprocess
-from urllib.error import URLError
-from urllib.request import urlopen
+import shutil
+import socket
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+from urllib.error import HTTPError
+from urllib.parse import urljoin, urlsplit
+from urllib.request import Request, getproxies, proxy_bypass, urlopen
 
 from module.checksum import CHECKSUMS
+from module.decompress import extract, transcode
+from module.util import timed
 
-def validate_and_download(path: Path, url: str):
-  MAX_RETRY = 3
+CHUNK_SIZE = 1 << 20
+
+# connections to the same host at the same time
+PER_HOST = 4
+MAX_REDIRECT = 10
+TIMEOUT = 60
+# attempts of a download, and delay before the first retry (seconds, doubled on every retry)
+RETRY = 5
+BACKOFF = 2.0
+# with other mirrors left, a download slower than `MIN_SPEED` (bytes per second)
+# over `SLOW_WINDOW` (seconds) fails over to the next mirror
+MIN_SPEED = 100 << 10
+SLOW_WINDOW = 20
+# bytes fetched to rank mirrors
+PROBE_SIZE = 256 << 10
+
+# keep-alive connections by host, shared by downloads of all threads.
+# mirrors (e.g. ftpmirror.gnu.org) redirect, the pool follows redirects itself to reuse
+# connections to the final host.
+class ConnectionPool:
+  per_host: int
+  lock: threading.Lock
+  idle: Dict[Tuple[str, str], List[HTTPConnection]]
+  slots: Dict[Tuple[str, str], threading.Semaphore]
+  # connections in use by an owner (e.g. a probe), and owners given up, see `abort`
+  active: Dict[str, Set[HTTPConnection]]
+  aborted: Set[str]
+
+  def __init__(self, per_host: int = PER_HOST):
+    self.per_host = per_host
+    self.lock = threading.Lock()
+    self.idle = {}
+    self.slots = {}
+    self.active = {}
+    self.aborted = set()
+
+  def _slot(self, host: Tuple[str, str]) -> threading.Semaphore:
+    with self.lock:
+      if host not in self.slots:
+        self.slots[host] = threading.Semaphore(self.per_host)
+      return self.slots[host]
+
+  def _connect(self, host: Tuple[str, str]) -> HTTPConnection:
+    scheme, netloc = host
+    if scheme == 'https':
+      return HTTPSConnection(netloc, timeout = TIMEOUT)
+    return HTTPConnection(netloc, timeout = TIMEOUT)
+
+  def _track(self, owner: Optional[str], connection: HTTPConnection):
+    if owner is None:
+      return
+    with self.lock:
+      if owner in self.aborted:
+        connection.close()
+        raise OSError(f'aborted: {owner}')
+      self.active.setdefault(owner, set()).add(connection)
+
+  def _untrack(self, owner: Optional[str], connection: HTTPConnection):
+    if owner is None:
+      return
+    with self.lock:
+      connections = self.active.get(owner, set())
+      connections.discard(connection)
+      if not connections:
+        self.active.pop(owner, None)
+
+  def _request(self, host: Tuple[str, str], path: str, headers: Dict[str, str], owner: Optional[str]) -> Tuple[HTTPConnection, HTTPResponse]:
+    with self.lock:
+      idle = self.idle.get(host, [])
+      connection = idle.pop() if idle else None
+    if connection is not None:
+      self._track(owner, connection)
+      try:
+        connection.request('GET', path, headers = headers)
+        return connection, connection.getresponse()
+      except (HTTPException, OSError):
+        # closed by the server while idle
+        self._untrack(owner, connection)
+        connection.close()
+    connection = self._connect(host)
+    self._track(owner, connection)
+    try:
+      connection.request('GET', path, headers = headers)
+      return connection, connection.getresponse()
+    except BaseException:
+      self._untrack(owner, connection)
+      connection.close()
+      raise
+
+  # gives up the requests of `owner`: its connections are shut down, so that blocked reads fail
+  # and free their host slots, and later requests of it fail at once
+  def abort(self, owner: str):
+    with self.lock:
+      self.aborted.add(owner)
+      connections = self.active.pop(owner, set())
+    for connection in connections:
+      sock = connection.sock
+      if sock is None:
+        continue
+      try:
+        sock.shutdown(socket.SHUT_RDWR)
+      except OSError:
+        pass
+
+  # yields the response of a GET, raises `HTTPError` unless it is 200 (or 206 for a range request).
+  # requests of an `owner` can be given up by another thread, see `abort`
+  @contextmanager
+  def get(self, url: str, headers: Dict[str, str] = {}, owner: Optional[str] = None) -> Iterator[HTTPResponse]:
+    scheme = urlsplit(url).scheme
+    if getproxies().get(scheme) and not proxy_bypass(urlsplit(url).hostname):
+      with urlopen(Request(url, headers = headers)) as response:
+        yield response
+      return
+
+    for _ in range(MAX_REDIRECT):
+      parts = urlsplit(url)
+      host = (parts.scheme, parts.netloc)
+      path = parts.path + (f'?{parts.query}' if parts.query else '')
+      with self._slot(host):
+        connection, response = self._request(host, path, headers, owner)
+        try:
+          if response.status in (301, 302, 303, 307, 308):
+            response.read()
+            url = urljoin(url, response.getheader('Location'))
+          elif response.status in (200, 206):
+            yield response
+            return
+          else:
+            response.read()
+            raise HTTPError(url, response.status, response.reason, response.headers, None)
+        finally:
+          self._untrack(owner, connection)
+          # reusable once the response is read to its end, unless it was aborted
+          with self.lock:
+            reuse = owner not in self.aborted and response.isclosed() and not response.will_close
+            if reuse:
+              self.idle.setdefault(host, []).append(connection)
+          if not reuse:
+            connection.close()
+    raise HTTPError(url, 310, 'Too many redirects', None, None)
+
+_pool = ConnectionPool()
+
+# sidecar index of verified archives in their directory, an archive whose
+# (size, mtime_ns, inode) did not change since it was verified is not hashed again
+class ChecksumIndex:
+  path: Path
+  lock: threading.Lock
+  entries: Dict[str, Dict]
+
+  def __init__(self, path: Path):
+    self.path = path
+    self.lock = threading.Lock()
+    try:
+      self.entries = json.loads(path.read_text())
+    except (OSError, ValueError):
+      self.entries = {}
+
+  @staticmethod
+  def _stat(file: Path) -> Dict:
+    st = file.stat()
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'inode': st.st_ino}
+
+  def verified(self, file: Path, checksum: str) -> bool:
+    with self.lock:
+      entry = self.entries.get(file.name)
+    return entry == {**self._stat(file), 'sha256': checksum}
+
+  def record(self, file: Path, checksum: str):
+    with self.lock:
+      self.entries[file.name] = {**self._stat(file), 'sha256': checksum}
+      partial = self.path.with_name(f'{self.path.name}.{os.getpid()}.part')
+      partial.write_text(json.dumps(self.entries, indent = 2, sort_keys = True))
+      partial.rename(self.path)
+
+_indexes: Dict[Path, ChecksumIndex] = {}
+_indexes_lock = threading.Lock()
+
+def _index(directory: Path) -> ChecksumIndex:
+  with _indexes_lock:
+    if directory not in _indexes:
+      _indexes[directory] = ChecksumIndex(directory / '.verified.json')
+    return _indexes[directory]
+
+FICLONE = 0x40049409
+
+# hardlink, or reflink across file systems that support it, or copy.
+# a reflink or copy goes through `.part`, an interrupted one never leaves a truncated `dst`
+def _link(src: Path, dst: Path):
+  try:
+    os.link(src, dst)
+    return
+  except OSError:
+    pass
+  partial = dst.with_name(f'{dst.name}.{os.getpid()}.{threading.get_ident()}.part')
+  try:
+    with open(src, 'rb') as fsrc, open(partial, 'wb') as fdst:
+      try:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+      except OSError:
+        shutil.copyfileobj(fsrc, fdst, CHUNK_SIZE)
+    os.replace(partial, dst)
+  finally:
+    partial.unlink(missing_ok = True)
+
+# optional content-addressed store shared by checkouts: `<store>/sha256/<hash>`.
+# archives are never modified in place, so hardlinks between the store and `assets` are safe.
+def _stored(store: Path, checksum: str) -> Path:
+  return store / 'sha256' / checksum
+
+def _publish(path: Path, checksum: str, store: Path):
+  stored = _stored(store, checksum)
+  if stored.exists():
+    return
+  stored.parent.mkdir(parents = True, exist_ok = True)
+  partial = stored.with_name(f'{checksum}.{os.getpid()}.{threading.get_ident()}.part')
+  _link(path, partial)
+  partial.rename(stored)
+
+# `--transcode`: zstd twins of source archives, decoded several times faster than xz and bz2.
+# a twin is named by the upstream checksum it was made from, `<dir>/<hash>.tar.zst`,
+# with its provenance (upstream archive and checksum, checksum of the twin) in `<dir>/<hash>.json`.
+TRANSCODE_SUFFIXES = ['.bz2', '.gz', '.lz', '.xz']
+
+# archives to extract instead of the upstream ones, filled by `validate_and_download`
+_twins: Dict[Path, Path] = {}
+
+def _use_twin(path: Path, checksum: str, directory: Path, paranoid: bool):
+  twin = directory / f'{checksum}.tar.zst'
+  provenance = directory / f'{checksum}.json'
+  index = _index(directory)
+  if twin.exists() and provenance.exists():
+    record = json.loads(provenance.read_text())
+    if record['sha256'] == checksum:
+      if not paranoid and index.verified(twin, record['zstd_sha256']):
+        _twins[path] = twin
+        return
+      if _sha256_file(twin) == record['zstd_sha256']:
+        index.record(twin, record['zstd_sha256'])
+        _twins[path] = twin
+        return
+    logging.warning('Transcode: twin of %s does not match its provenance, transcoding again', path.name)
+
+  logging.info('Transcoding %s', path.name)
+  directory.mkdir(parents = True, exist_ok = True)
+  partial = twin.with_name(f'{twin.name}.{os.getpid()}.{threading.get_ident()}.part')
+  returncode = transcode(f'{path.name} (transcode)', path, partial)
+  if returncode != 0:
+    # not fatal, the upstream archive is extracted instead
+    partial.unlink(missing_ok = True)
+    logging.warning('Transcode fail: returned %d transcoding %s', returncode, path.name)
+    return
+  zstd_checksum = _sha256_file(partial)
+  partial.rename(twin)
+  record = {'source': path.name, 'sha256': checksum, 'zstd_sha256': zstd_checksum}
+  partial = provenance.with_name(f'{provenance.name}.{os.getpid()}.{threading.get_ident()}.part')
+  partial.write_text(json.dumps(record, indent = 2))
+  partial.rename(provenance)
+  index.record(twin, zstd_checksum)
+  _twins[path] = twin
+
+def _hash_file(path: Path):
+  h = sha256()
+  with open(path, 'rb') as f:
+    while chunk := f.read(CHUNK_SIZE):
+      h.update(chunk)
+  return h
+
+def _sha256_file(path: Path) -> str:
+  return _hash_file(path).hexdigest()
+
+# seconds to fetch the head of `url`, None if it fails
+def probe(url: str) -> Optional[float]:
+  start = time.time()
+  try:
+    with _pool.get(url, {'Range': f'bytes=0-{PROBE_SIZE - 1}'}, owner = url) as response:
+      remaining = PROBE_SIZE
+      while remaining > 0 and (chunk := response.read(min(remaining, CHUNK_SIZE))):
+        remaining -= len(chunk)
+  except (HTTPException, OSError) as e:
+    logging.info('Probe fail: %s: %s', url, getattr(e, 'reason', e))
+    return None
+  return time.time() - start
+
+# gives up a probe still running, so that it does not hold a connection slot of its host
+def abort_probe(url: str):
+  _pool.abort(url)
+
+class SlowDownload(OSError):
+  pass
+
+# downloads to `.part`, resumed with a range request after a broken connection (also by a later run,
+# or from another mirror)
+def _download(path: Path, url: str, partial: Path, check_speed: bool) -> Tuple[bool, bool]:
+  if partial.exists():
+    # the hash state is not serializable, rebuild it from the downloaded part
+    h = _hash_file(partial)
+    offset = partial.stat().st_size
+  else:
+    h = sha256()
+    offset = 0
+  headers = {'Range': f'bytes={offset}-'} if offset else {}
+  with timed(f'{path.name} (download)', 'download'), _pool.get(url, headers) as response:
+    resumed = offset > 0 and response.status == 206 and \
+      (response.getheader('Content-Range') or '').startswith(f'bytes {offset}-')
+    if offset > 0 and not resumed:
+      logging.info('Download %s: range not supported, restarting', path.name)
+      h = sha256()
+    start = time.time()
+    received = 0
+    with open(partial, 'ab' if resumed else 'wb') as f:
+      while chunk := response.read(CHUNK_SIZE):
+        h.update(chunk)
+        f.write(chunk)
+        received += len(chunk)
+        elapsed = time.time() - start
+        if check_speed and elapsed > SLOW_WINDOW and received / elapsed < MIN_SPEED:
+          raise SlowDownload(f'{received / elapsed / 1024:.0f} KiB/s from {url}')
+    # `read(amt)` returns short at a closed connection, keep the part to resume
+    if response.length:
+      raise IncompleteRead(b'', response.length)
+  return h.hexdigest() == CHECKSUMS[path.name], resumed
+
+# `urls` are mirrors of the archive, tried in turn
+# `paranoid` hashes existing archives even if they are in the checksum index.
+# with a `store`, archives are taken from and added to it.
+# with `transcode`, verified archives are extracted from their zstd twins (kept in the store, or in `assets/.zstd`).
+def validate_and_download(
+  path: Path,
+  urls: List[str],
+  retry: int = RETRY,
+  backoff: float = BACKOFF,
+  paranoid: bool = False,
+  store: Optional[Path] = None,
+  transcode: bool = False,
+):
+  _fetch(path, urls, retry, backoff, paranoid, store)
+  if transcode and path.suffix in TRANSCODE_SUFFIXES:
+    _use_twin(path, CHECKSUMS[path.name], store / 'zstd' if store is not None else path.parent / '.zstd', paranoid)
+
+def _fetch(
+  path: Path,
+  urls: List[str],
+  retry: int,
+  backoff: float,
+  paranoid: bool,
+  store: Optional[Path],
+):
   checksum = CHECKSUMS[path.name]
+  index = _index(path.parent)
+  if not path.exists() and store is not None and _stored(store, checksum).exists():
+    logging.info('Linking %s from %s', path.name, store)
+    _link(_stored(store, checksum), path)
   if path.exists():
-    with open(path, 'rb') as f:
-      body = f.read()
-      if checksum != sha256(body).hexdigest():
+    if paranoid or not index.verified(path, checksum):
+      if checksum != _sha256_file(path):
         message = 'Validate fail: %s exists but checksum mismatch' % path.name
         logging.critical(message)
         logging.info('Please delete %s and try again' % path.name)
         raise Exception(message)
+      index.record(path, checksum)
+    if store is not None:
+      _publish(path, checksum, store)
   else:
     logging.info('Downloading %s' % path.name)
+    # streamed to `.part` and hashed on the fly, renamed once verified
+    partial = path.with_name(path.name + '.part')
     retry_count = 0
     while True:
       retry_count += 1
       try:
-        response = urlopen(url)
-        body = response.read()
-        if checksum != sha256(body).hexdigest():
-          message = 'Download fail: checksum mismatch for %s' % path.name
+        url = urls[(retry_count - 1) % len(urls)]
+        ok, resumed = _download(path, url, partial, len(urls) > 1 and retry_count < retry)
+        if ok:
+          partial.rename(path)
+          index.record(path, checksum)
+          if store is not None:
+            _publish(path, checksum, store)
+          return
+        partial.unlink()
+        message = 'Download fail: checksum mismatch for %s' % path.name
+        # a stale part may come from a different file, start over
+        if not resumed or retry_count >= retry:
           logging.critical(message)
           raise Exception(message)
-        with open(path, "wb") as f:
-          f.write(body)
-          return
-      except URLError as e:
-        message = 'Download fail: %s (retry %d/3)' % (e.reason, retry_count)
-        if retry_count < MAX_RETRY:
-          logging.warning(message)
-          logging.warning('Retrying...')
-        else:
+        logging.warning(message)
+      except (HTTPException, OSError) as e:
+        # the part is already complete (or stale)
+        if isinstance(e, HTTPError) and e.code == 416:
+          partial.unlink(missing_ok = True)
+        message = 'Download fail: %s (retry %d/%d)' % (getattr(e, 'reason', e), retry_count, retry)
+        if retry_count >= retry:
+          # the part is kept, the next run resumes it
           logging.critical(message)
           raise e
+        logging.warning(message)
+      # next mirror right away, back off once all of them failed
+      if retry_count % len(urls) == 0:
+        delay = backoff * 2 ** (retry_count // len(urls) - 1)
+        logging.warning('Retrying in %.0fs...', delay)
+        time.sleep(delay)
+
+# components are prepared concurrently, extraction is bounded to spare the disk
+EXTRACT_JOBS = min(os.cpu_count() or 1, 4)
+_extract_slots = threading.BoundedSemaphore(EXTRACT_JOBS)
+
+def limit_extract(jobs: int):
+  global _extract_slots
+  _extract_slots = threading.BoundedSemaphore(max(jobs, 1))
+
+# skips `entry` of the archive's top directory and everything below it
+def _skip(entry: str) -> List[str]:
+  pattern = ''.join('[^/]*' if c == '*' else f'\\{c}' if c in '.[]\\^$' else c for c in entry)
+  # `S`: symlink targets are kept as they are
+  return ['-s', f'#^[^/]*/{pattern}\\(/.*\\)*$##S']
 
-def check_and_extract(path: Path, arx: Path):
+# `exclude`: paths relative to the top directory, not extracted (see `module.exclude`)
+# `members`: paths relative to the top directory, only these are extracted
+def check_and_extract(path: Path, arx: Path, exclude: List[str] = [], members: List[str] = []):
   # check if already extracted
   if path.exists():
     mark = path / '.patched'
@@ -54,16 +449,20 @@ def check_and_extract(path: Path, arx: Path):
       logging.info('Please delete %s and try again' % path.name)
       raise Exception(message)
 
-  # extract
-  res = subprocess.run([
-    'bsdtar',
-    '-xf',
-    arx,
-    '--no-same-owner',
-  ], cwd = path.parent)
-  if res.returncode != 0:
-    message = 'Extract fail: bsdtar returned %d extracting %s' % (res.returncode, arx.name)
+  # extract, `path` may be named differently from the archive's top directory
+  path.mkdir(parents = True)
+  with _extract_slots:
+    start = time.time()
+    returncode = extract(f'{arx.name} (extract)', _twins.get(arx, arx), path, [
+      '--no-same-owner',
+      *(arg for entry in exclude for arg in _skip(entry)),
+      '--strip-components', '1',
+      *(f'*/{member}' for member in members),
+    ])
+  if returncode != 0:
+    message = 'Extract fail: returned %d extracting %s' % (returncode, arx.name)
     logging.critical(message)
     raise Exception(message)
+  logging.info('Extracted %s in %.1fs', arx.name, time.time() - start)
 
   return True
@@ -0,0 +1,242 @@
+import json
+import logging
+from pathlib import Path
+import sqlite3
+from statistics import median
+import time
+from typing import Dict, List, Optional, Tuple
+
+from module.report import BuildReport
+from module.stage import StageGraph
+
+# timings of every run, by branch, to spot build time regressions (e.g. after a version bump in `module.profile`).
+# stage names are stored without the branch prefix, so single- and multi-branch runs compare.
+
+# runs compared against
+WINDOW = 10
+# ignore regressions shorter than this (seconds), small steps are noisy
+MIN_REGRESSION = 10
+
+SCHEMA = '''
+create table if not exists runs (
+  id integer primary key,
+  branch text not null,
+  started real not null,
+  wall real not null,
+  ok integer not null,
+  profile text not null
+);
+create table if not exists stages (
+  run integer not null references runs(id),
+  ord integer not null,
+  name text not null,
+  deps text not null,
+  start real not null,
+  wall real not null,
+  ok integer not null
+);
+create table if not exists steps (
+  run integer not null references runs(id),
+  stage text,
+  step text not null,
+  command text not null,
+  start real not null,
+  wall real not null,
+  user real,
+  sys real,
+  max_rss integer,
+  returncode integer
+);
+create index if not exists runs_branch on runs(branch, started);
+'''
+
+def _connect(path: Path) -> sqlite3.Connection:
+  path.parent.mkdir(parents = True, exist_ok = True)
+  db = sqlite3.connect(path)
+  db.executescript(SCHEMA)
+  return db
+
+def _unscoped(report: BuildReport, name: Optional[str]) -> Optional[str]:
+  if name is None:
+    return None
+  return name.removeprefix(f'[{report.branch}] ')
+
+# dependencies between the stages that ran, through joins and skipped stages
+def _deps(graph: StageGraph, ran: set, name: str) -> List[str]:
+  result = []
+  pending = list(graph.stages[name].deps)
+  seen = set()
+  while pending:
+    dep = pending.pop()
+    if dep in seen:
+      continue
+    seen.add(dep)
+    if dep in ran:
+      result.append(dep)
+    else:
+      pending.extend(graph.stages[dep].deps)
+  return sorted(result)
+
+def record(path: Path, graph: StageGraph, report: BuildReport, profile: str, ok: bool):
+  order = {name: i for i, name in enumerate(graph.stages)}
+  with report.lock:
+    stages = sorted(report.stages, key = lambda stage: order.get(stage['name'], len(order)))
+    steps = list(report.steps)
+  ran = {stage['name'] for stage in stages}
+
+  db = _connect(path)
+  with db:
+    run = db.execute(
+      'insert into runs (branch, started, wall, ok, profile) values (?, ?, ?, ?, ?)',
+      (report.branch, report.started, round(time.time() - report.started, 3), ok, profile),
+    ).lastrowid
+    db.executemany(
+      'insert into stages values (?, ?, ?, ?, ?, ?, ?)',
+      [
+        (
+          run, i, _unscoped(report, stage['name']),
+          json.dumps([_unscoped(report, dep) for dep in _deps(graph, ran, stage['name'])]),
+          stage['start'], stage['wall'], stage['ok'],
+        )
+        for i, stage in enumerate(stages)
+      ],
+    )
+    db.executemany(
+      'insert into steps values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+      [
+        (
+          run, _unscoped(report, step['stage']), step['step'], step['command'],
+          step['start'], step['wall'], step['user'], step['sys'], step['max_rss'], step['returncode'],
+        )
+        for step in steps
+      ],
+    )
+  db.close()
+
+# expected duration of the graph's stages, the median of their previous successful runs
+def predict(path: Path, graph: StageGraph) -> Dict[str, float]:
+  if not path.exists():
+    return {}
+  db = _connect(path)
+  samples: Dict[Tuple[str, str], List[float]] = {}
+  branches = {stage.report.branch for stage in graph.stages.values() if stage.report is not None}
+  for branch in branches:
+    runs = db.execute(
+      'select id from runs where branch = ? and ok order by started desc limit ?',
+      (branch, WINDOW),
+    ).fetchall()
+    for (run,) in runs:
+      for name, wall in db.execute('select name, wall from stages where run = ? and ok', (run,)):
+        samples.setdefault((branch, name), []).append(wall)
+  db.close()
+
+  result = {}
+  for stage in graph.stages.values():
+    if stage.report is None:
+      continue
+    name = _unscoped(stage.report, stage.name)
+    if (stage.report.branch, name) in samples:
+      result[stage.name] = median(samples[(stage.report.branch, name)])
+    else:
+      # shared stages belong to the first branch asking for them, which may differ between runs
+      other = [wall for (_, other), walls in samples.items() if other == name for wall in walls]
+      if other:
+        result[stage.name] = median(other)
+  return result
+
+def _stages(db: sqlite3.Connection, run: int) -> Dict[str, Tuple[float, List[str]]]:
+  rows = db.execute('select name, wall, deps from stages where run = ? order by ord', (run,))
+  return {name: (wall, json.loads(deps)) for name, wall, deps in rows}
+
+# a step may run several times in a stage (e.g. make, then make install), numbered by start time
+def _steps(db: sqlite3.Connection, run: int) -> Dict[Tuple[str, str, int], float]:
+  result = {}
+  count: Dict[Tuple[str, str], int] = {}
+  for stage, step, wall in db.execute('select stage, step, wall from steps where run = ? order by start', (run,)):
+    n = count.get((stage, step), 0)
+    count[(stage, step)] = n + 1
+    result[(stage, step, n)] = wall
+  return result
+
+def critical_path(stages: Dict[str, Tuple[float, List[str]]]) -> List[str]:
+  # stages are in declaration order, dependencies come first
+  finish: Dict[str, float] = {}
+  via: Dict[str, Optional[str]] = {}
+  for name, (wall, deps) in stages.items():
+    before = max((dep for dep in deps if dep in finish), key = lambda dep: finish[dep], default = None)
+    finish[name] = wall + (finish[before] if before is not None else 0)
+    via[name] = before
+  path = []
+  name = max(finish, key = lambda name: finish[name], default = None)
+  while name is not None:
+    path.append(name)
+    name = via[name]
+  return path[::-1]
+
+def _regressions(current: Dict, previous: List[Dict], threshold: float) -> List[Tuple[str, float, float]]:
+  result = []
+  for key, wall in current.items():
+    samples = [run[key] for run in previous if key in run]
+    if not samples:
+      continue
+    typical = median(samples)
+    if wall > typical * (1 + threshold) and wall - typical >= MIN_REGRESSION:
+      result.append((key, typical, wall))
+  return result
+
+def _versions(profile: str) -> Dict[str, str]:
+  return {key: value for key, value in json.loads(profile).items() if isinstance(value, str)}
+
+# prints the latest run of `branch` against the median of its previous successful runs,
+# returns False if it regressed.
+def analyze(path: Path, branch: str, threshold: float) -> bool:
+  if not path.exists():
+    message = 'History fail: %s does not exist' % path
+    logging.critical(message)
+    raise Exception(message)
+  db = _connect(path)
+  runs = db.execute(
+    'select id, wall, ok, profile from runs where branch = ? order by started desc',
+    (branch,),
+  ).fetchall()
+  if not runs:
+    print(f'GCC {branch}: no history')
+    db.close()
+    return True
+
+  run, wall, ok, profile = runs[0]
+  previous = [row for row in runs[1:] if row[2]][:WINDOW]
+  stages = _stages(db, run)
+  print(f'GCC {branch}: {wall:.0f}s{"" if ok else " (failed)"}, compared with {len(previous)} previous runs')
+
+  critical = critical_path(stages)
+  print(f'  critical path: {sum(stages[name][0] for name in critical):.0f}s')
+  for name in critical:
+    print(f'    {stages[name][0]:8.0f}s  {name}')
+
+  # version bumps since the last successful run
+  if previous:
+    old = _versions(previous[0][3])
+    for key, value in _versions(profile).items():
+      if old.get(key) != value:
+        print(f'  {key}: {old.get(key)} -> {value}')
+
+  regressions = _regressions(
+    {'(total)': wall},
+    [{'(total)': row[1]} for row in previous],
+    threshold,
+  )
+  regressions += _regressions(
+    {name: wall for name, (wall, _) in stages.items()},
+    [{name: wall for name, (wall, _) in _stages(db, row[0]).items()} for row in previous],
+    threshold,
+  )
+  regressions += [
+    (f'{stage} / {step}' + (f' #{n + 1}' if n else ''), typical, wall)
+    for (stage, step, n), typical, wall in _regressions(_steps(db, run), [_steps(db, row[0]) for row in previous], threshold)
+  ]
+  db.close()
+
+  for name, typical, wall in regressions:
+    print(f'  regression: {name}: {wall:.0f}s, median {typical:.0f}s (+{wall - typical:.0f}s)')
+  return not regressions
@@ -0,0 +1,91 @@
+from contextlib import contextmanager
+import os
+import select
+from typing import Dict, Iterator, Optional, Tuple
+
+# GNU make jobserver shared by all concurrently running stages.
+#
+# the pipe holds one token per job. every running stage holds a token, which
+# stands for the implicit job slot of the make (or configure) it spawns; make
+# takes further tokens from the pipe, so total parallelism stays at `jobs`.
+
+class Jobserver:
+  jobs: int
+  read_fd: int
+  write_fd: int
+
+  def __init__(self, jobs: int):
+    self.jobs = jobs
+    self.read_fd, self.write_fd = os.pipe()
+    os.write(self.write_fd, b'+' * jobs)
+
+  def acquire(self) -> bytes:
+    while True:
+      try:
+        return os.read(self.read_fd, 1)
+      except InterruptedError:
+        continue
+
+  def try_acquire(self) -> Optional[bytes]:
+    readable, _, _ = select.select([self.read_fd], [], [], 0)
+    if not readable:
+      return None
+    return self.acquire()
+
+  def release(self, token: bytes):
+    os.write(self.write_fd, token)
+
+  # `--jobserver-fds` is understood by make 4.0 to 4.4, `--jobserver-auth` only since 4.2
+  def makeflags(self) -> str:
+    return f' -j --jobserver-fds={self.read_fd},{self.write_fd}'
+
+_jobserver: Optional[Jobserver] = None
+
+def start(jobs: int) -> Jobserver:
+  global _jobserver
+  _jobserver = Jobserver(jobs)
+  return _jobserver
+
+def current() -> Optional[Jobserver]:
+  return _jobserver
+
+def environ(base: Dict[str, str]) -> Dict[str, str]:
+  env = dict(base)
+  if _jobserver is not None:
+    env['MAKEFLAGS'] = _jobserver.makeflags()
+  return env
+
+def pass_fds() -> Tuple[int, ...]:
+  if _jobserver is None:
+    return ()
+  return (_jobserver.read_fd, _jobserver.write_fd)
+
+@contextmanager
+def token() -> Iterator[None]:
+  if _jobserver is None:
+    yield
+    return
+  held = _jobserver.acquire()
+  try:
+    yield
+  finally:
+    _jobserver.release(held)
+
+# for tools that do not speak the jobserver protocol (e.g. xmake):
+# grab whatever tokens are free right now, up to `jobs` slots in total.
+@contextmanager
+def slots(jobs: int) -> Iterator[int]:
+  if _jobserver is None:
+    yield jobs
+    return
+  held = []
+  try:
+    while len(held) + 1 < jobs:
+      extra = _jobserver.try_acquire()
+      if extra is None:
+        break
+      held.append(extra)
+    yield len(held) + 1
+  finally:
+    for extra in held:
+      _jobserver.release(extra)
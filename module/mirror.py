@@ -0,0 +1,79 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+import logging
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from module.fetch import abort_probe, probe
+
+# mirrors by source family, in order of preference.
+# `--mirror <family>=<url>` puts a mirror in front of its family.
+MIRRORS = {
+  'gnu': [
+    'https://ftpmirror.gnu.org/gnu',
+    'https://ftp.gnu.org/gnu',
+    'https://mirrors.kernel.org/gnu',
+  ],
+  'gcc-snapshot': [
+    'https://gcc.gnu.org/pub/gcc/snapshots',
+    'https://sourceware.org/pub/gcc/snapshots',
+  ],
+  'kernel': [
+    'https://cdn.kernel.org/pub/linux/kernel',
+    'https://mirrors.edge.kernel.org/pub/linux/kernel',
+  ],
+  'python': [
+    'https://www.python.org/ftp/python',
+  ],
+  'sourceforge': [
+    'https://downloads.sourceforge.net/project',
+  ],
+  'zlib': [
+    'https://zlib.net/fossils',
+  ],
+}
+
+# probes are abandoned after this (seconds), unfinished mirrors are tried last
+PROBE_TIMEOUT = 10
+
+# mirrors by family, ranked by `rank`
+_ranked: Dict[str, List[str]] = {}
+
+# orders the mirrors of each family by the time to fetch the head of one of its archives
+def rank(sources: List[Tuple[Path, str, str]], extra: Dict[str, List[str]] = {}):
+  mirrors = {family: [*extra.get(family, []), *urls] for family, urls in MIRRORS.items()}
+
+  # only families with archives to download are probed
+  samples = {}
+  for arx, family, path in sources:
+    if not arx.exists():
+      samples.setdefault(family, path)
+  candidates = [(family, url) for family, path in samples.items() if len(mirrors[family]) > 1 for url in mirrors[family]]
+
+  elapsed: Dict[Tuple[str, str], Optional[float]] = {}
+  if candidates:
+    pool = ThreadPoolExecutor(max_workers = len(candidates))
+    futures = {pool.submit(probe, f'{url}/{samples[family]}'): (family, url) for family, url in candidates}
+    done, pending = wait(futures, timeout = PROBE_TIMEOUT)
+    # unfinished probes would keep their connections (and host slots) until the socket timeout
+    for future in pending:
+      future.cancel()
+      family, url = futures[future]
+      abort_probe(f'{url}/{samples[family]}')
+    pool.shutdown(wait = False)
+    for future in done:
+      elapsed[futures[future]] = future.result()
+
+  def time(family: str, url: str) -> float:
+    seconds = elapsed.get((family, url))
+    return seconds if seconds is not None else float('inf')
+
+  for family in samples:
+    if len(mirrors[family]) > 1:
+      # stable, unreachable and slow mirrors keep their order at the end
+      mirrors[family].sort(key = lambda url: time(family, url))
+      logging.info('Mirror for %s: %s', family, mirrors[family][0])
+  _ranked.update(mirrors)
+
+# candidate urls of an archive, the fastest mirror first
+def urls(family: str, path: str) -> List[str]:
+  return [f'{url}/{path}' for url in _ranked.get(family, MIRRORS[family])]
@@ -0,0 +1,123 @@
+from packaging.specifiers import SpecifierSet
+from packaging.version import Version
+from pathlib import Path, PurePosixPath
+from typing import Dict, List, Optional, Tuple
+
+from module.profile import BranchProfile
+
+# patches of the source trees, in order of application, selected by the version of their component
+# (e.g. `ver.gcc` for gcc). `requires` names a profile field that must be set, e.g. gdb's python.
+# `./main.py -a --check-patches` tries the plans of all branches on pristine sources.
+
+class Patch:
+  component: str
+  file: str
+  versions: SpecifierSet
+  reason: str
+  requires: Optional[str]
+
+  def __init__(self, component: str, file: str, versions: str, reason: str, requires: Optional[str] = None):
+    self.component = component
+    self.file = file
+    self.versions = SpecifierSet(versions)
+    self.reason = reason
+    self.requires = requires
+
+PATCHES: List[Patch] = [
+  Patch('binutils', 'backport_2.37.patch', '==2.37', 'backport'),
+  Patch('binutils', 'backport_2.33.1.patch', '==2.33.1', 'backport'),
+  Patch('binutils', 'backport_2.27.patch', '==2.27', 'backport'),
+  Patch('binutils', 'fix-path-corruption_2.43.patch', '>=2.43', 'fix path corruption'),
+  Patch('binutils', 'fix-path-corruption_2.41.patch', '>=2.41,<2.43', 'fix path corruption'),
+  Patch('binutils', 'fix-path-corruption_2.39.patch', '>=2.39,<2.41', 'fix path corruption'),
+  Patch('binutils', 'fix-elf-compress-alignment_2.30.patch', '>=2.30,<2.32', 'fix elf compress alignment'),
+  Patch('binutils', 'fix-elf-compress-alignment_2.29.patch', '>=2.29,<2.30', 'fix elf compress alignment'),
+  Patch('binutils', 'fix-elf-compress-alignment_2.26.patch', '>=2.26,<2.29', 'fix elf compress alignment'),
+  Patch('binutils', 'always-enable-sysroot.patch', '<2.26', 'always enable sysroot'),
+  Patch('binutils', 'fix-musl-locale-name.patch', '<2.29.1', 'fix musl locale name'),
+
+  Patch('gcc', 'backport_11.patch', '==11.*', 'poisoned calloc when building with musl'),
+  Patch('gcc', 'backport_10.patch', '==10.*', 'mingw define standard PRI macros when building against musl'),
+  Patch('gcc', 'backport_9.patch', '==9.*', 'mingw define standard PRI macros when building against musl'),
+  Patch('gcc', 'backport_8.patch', '==8.*', 'gcc fails to find cc1plus if built against ucrt due to a behaviour of `_access`'),
+  Patch('gcc', 'backport_7.patch', '==7.*', 'someone declared `bool error_p = NULL`, it works until musl 1.2 defines NULL to nullptr'),
+  Patch('gcc', 'backport_6.patch', '==6.*', 'someone declared `bool error_p = NULL`; intl adds `-liconv` without proper libdir'),
+  Patch('gcc', 'backport_5.patch', '==5.*', 'someone declared `bool error_p = NULL`, it works until musl 1.2 defines NULL to nullptr'),
+  Patch('gcc', 'fix-lang-std_4.9.patch', '>=4.9,<6', 'fix failure due to language standard evolve'),
+  Patch('gcc', 'fix-lang-std_4.8.patch', '<4.9', 'fix failure due to language standard evolve'),
+  Patch('gcc', 'backport-with-glibc-version_4.8.5.patch', '==4.8.5', 'backport `--with-glibc-version`'),
+  Patch('gcc', 'fix-libc-libgcc-libc-dep_9.patch', '>=9', 'fix libc -> libgcc -> libc dependency'),
+  Patch('gcc', 'fix-libc-libgcc-libc-dep_8.patch', '>=8,<9', 'fix libc -> libgcc -> libc dependency'),
+  Patch('gcc', 'fix-libc-libgcc-libc-dep_4.8.patch', '<8', 'fix libc -> libgcc -> libc dependency'),
+  Patch('gcc', 'fix-make-variable_14.patch', '>=14', 'gcc 12 use `override CFLAGS +=` to handle PGO build, which breaks workaround for ucrt `access`'),
+  Patch('gcc', 'fix-make-variable_12.patch', '>=12,<14', 'gcc 12 use `override CFLAGS +=` to handle PGO build, which breaks workaround for ucrt `access`'),
+  Patch('gcc', 'fix-libatomic-build.patch', '>=4.8,<10', 'fix libatomic build'),
+  Patch('gcc', 'fix-sanitizer-dep.patch', '==13.*', 'fix sanitizer dependency of crypt'),
+  Patch('gcc', 'fix-vt-seq_12.patch', '>=12', 'fix VT sequence'),
+  Patch('gcc', 'fix-vt-seq_8.patch', '>=8,<12', 'fix VT sequence'),
+  Patch('gcc', 'fix-localedir_12.patch', '>=12', 'fix locale directory'),
+  Patch('gcc', 'fix-localedir_4.8.patch', '<12', 'fix locale directory'),
+  Patch('gcc', 'fix-libcpp-setlocale.patch', '', 'libcpp defines `setlocale` if `HAVE_SETLOCALE` not defined, but its configure.ac does not check `setlocale` at all'),
+  Patch('gcc', 'fix-console-cp.patch', '>=13', 'fix console code page'),
+
+  Patch('gdb', 'backport_10.patch', '==10.*', 'backport'),
+  Patch('gdb', 'backport_8.3.1.patch', '==8.3.1', 'backport'),
+  Patch('gdb', 'backport-stub-termcap_7.8.2.patch', '==7.8.2', 'backport stub termcap'),
+  Patch('gdb', 'backport-stub-termcap_7.6.2.patch', '==7.6.2', 'backport stub termcap'),
+  Patch('gdb', 'fix-iconv-cp65001.patch', '', "fix iconv 'CP65001'"),
+  Patch('gdb', 'fix-pythondir.patch', '', 'fix pythondir', requires = 'python'),
+
+  # glibc locks autoconf version, here we patch configure instead of autoreconf
+  # we do not use make 3.x because it's not easy to build on modern systems
+  Patch('glibc', 'fix-make-4.x_2.18.patch', '==2.18', 'fix make 4.x'),
+  # glibc wrongly implements host tool `rpcgen` as glibc-only
+  # since they finally removed it, we disable it for old versions
+  Patch('glibc', 'disable-sunrpc.patch', '<2.26', 'disable sunrpc'),
+
+  Patch('kernel', 'fix-x86-reloc-redefinition.patch', '<3.18', 'fix x86 reloc redefinition'),
+
+  Patch('make', 'backport_4.3.patch', '==4.3', 'backport'),
+  Patch('make', 'fix-fcntl-decl.patch', '==4.3', 'fix fcntl declaration'),
+
+  Patch('python', 'disable-shared-xxlimited_3.12.patch', '>=3.12,<3.13', 'disable xxlimited shared library if `--disable-test-modules`'),
+  Patch('python', 'fix-mingw-build_3.13.patch', '>=3.13', 'fix mingw build with the alternative build system'),
+  Patch('python', 'fix-mingw-build_3.12.patch', '<3.13', 'fix mingw build with the alternative build system'),
+]
+
+# patch directories named differently from their component
+PATCH_DIRS = {
+  'kernel': 'linux',
+}
+
+# patches by component, in order
+_index: Dict[str, List[Patch]] = {}
+for patch in PATCHES:
+  _index.setdefault(patch.component, []).append(patch)
+
+# `patch` is the root of patch directories, `paths.patch`
+def patch_dir(component: str, patch: Path) -> Path:
+  return patch / PATCH_DIRS.get(component, component)
+
+# patches of `component` for the versions of `ver`, in order of application
+def plan(component: str, ver: BranchProfile) -> List[Patch]:
+  version = Version(getattr(ver, component))
+  return [
+    patch
+    for patch in _index.get(component, [])
+    if patch.versions.contains(version, prereleases = True) and (patch.requires is None or getattr(ver, patch.requires))
+  ]
+
+# files changed by a patch applied with `-p1`, as (old, new) paths; None for /dev/null
+def targets(patch: Path) -> List[Tuple[Optional[PurePosixPath], Optional[PurePosixPath]]]:
+  result = []
+  previous = ''
+  for line in open(patch, errors = 'replace'):
+    # file headers, `--- a/<path>` followed by `+++ b/<path>`
+    if line.startswith('+++ ') and previous.startswith('--- '):
+      pair = []
+      for target in [previous[4:], line[4:]]:
+        target = target.split('\t')[0].strip()
+        pair.append(None if target == '/dev/null' else PurePosixPath(*PurePosixPath(target).parts[1:]))
+      result.append(tuple(pair))
+    previous = line
+  return result
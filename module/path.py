@@ -1,9 +1,25 @@
 import argparse
 from packaging.version import Version
 from pathlib import Path
-from typing import Callable
+from typing import Callable, List, Optional
 
+from module.checksum import CHECKSUMS
+from module.exclude import EXCLUDES
+from module.patches import patch_dir, plan
 from module.profile import BranchProfile
+from module.util import digest
+
+PREPARE_SOURCE = Path(__file__).parent / 'prepare_source.py'
+
+# what makes a patched tree of `component` besides its archive and patch directory: the planned patches
+# and the excluded trees. also hashed by keys of stages built from the tree (see `cache.cross_digest`)
+def source_inputs(component: str, ver: BranchProfile) -> List:
+  if not getattr(ver, component):
+    return []
+  return [
+    [patch.file for patch in plan(component, ver)],
+    EXCLUDES[component](ver) if component in EXCLUDES else [],
+  ]
 
 class ProjectPaths:
   root: Path
@@ -22,7 +38,10 @@ class ProjectPaths:
 
   # build phase
 
+  build_root: Path
   build: Path
+  shared: Path
+  src: Path
   x_dep: Path
 
   binutils: Path
@@ -95,88 +114,102 @@ class ProjectPaths:
 
     # build phase
 
-    self.build = Path(f'/tmp/build/gcc-{config.branch}')
-    self.x_dep = self.build / 'dep'
+    self.build_root = Path('/tmp/build')
+    self.build = self.build_root / f'gcc-{config.branch}'
+
+    # shared by branches, named by everything they depend on
+    self.shared = self.build_root / 'shared'
+    dep = f'dep-gmp-{ver.gmp}-mpfr-{ver.mpfr}-mpc-{ver.mpc}'
+    if ver.python_z:
+      dep += f'-zlib-{ver.python_z}'
+    self.x_dep = self.shared / dep
+
+    # patched sources are shared by branches and never written by builds,
+    # which use out-of-tree build directories in `build` (see `out`).
+    # python is built in-tree and stays in `build`.
+    self.src = self.build_root / 'src'
 
     binutils = f'binutils-{ver.binutils}'
-    self.binutils = self.build / binutils
     if Version(ver.binutils) >= Version('2.43'):
       self.binutils_arx = self.assets / f'{binutils}.tar.zst'
     elif Version(ver.binutils) >= Version('2.28.1'):
       self.binutils_arx = self.assets / f'{binutils}.tar.xz'
     else:
       self.binutils_arx = self.assets / f'{binutils}.tar.bz2'
+    self.binutils = self._source(binutils, self.binutils_arx, ver, 'binutils')
 
     gcc = f'gcc-{ver.gcc}'
-    self.gcc = self.build / gcc
     if Version(ver.gcc).major >= 5:
       self.gcc_arx = self.assets / f'{gcc}.tar.xz'
     else:
       self.gcc_arx = self.assets / f'{gcc}.tar.bz2'
+    self.gcc = self._source(gcc, self.gcc_arx, ver, 'gcc')
 
     gdb = f'gdb-{ver.gdb}'
-    self.gdb = self.build / gdb
     if Version(ver.gdb) >= Version('7.8'):
       self.gdb_arx = self.assets / f'{gdb}.tar.xz'
     else:
       self.gdb_arx = self.assets / f'{gdb}.tar.bz2'
+    self.gdb = self._source(gdb, self.gdb_arx, ver, 'gdb', bool(ver.python))
 
     if ver.gettext:
       gettext = f'gettext-{ver.gettext}'
-      self.gettext = self.build / gettext
       self.gettext_arx = self.assets / f'{gettext}.tar.xz'
+      self.gettext = self._source(gettext, self.gettext_arx, ver)
     else:
       self.gettext = None
       self.gettext_arx = None
 
     glibc = f'glibc-{ver.glibc}'
-    self.glibc = self.build / glibc
     self.glibc_arx = self.assets / f'{glibc}.tar.xz'
+    self.glibc = self._source(glibc, self.glibc_arx, ver, 'glibc')
 
     gmp = f'gmp-{ver.gmp}'
-    self.gmp = self.build / gmp
     if Version(ver.gmp) >= Version('6.2.0'):
       self.gmp_arx = self.assets / f'{gmp}.tar.zst'
     else:
       self.gmp_arx = self.assets / f'{gmp}.tar.xz'
+    self.gmp = self._source(gmp, self.gmp_arx, ver)
 
     iconv = f'libiconv-{ver.iconv}'
-    self.iconv = self.build / iconv
     self.iconv_arx = self.assets / f'{iconv}.tar.gz'
+    self.iconv = self._source(iconv, self.iconv_arx, ver)
 
     kernel = f'linux-{ver.kernel}'
-    self.kernel = self.build / kernel
     self.kernel_arx = self.assets / f'{kernel}.tar.xz'
+    self.kernel = self._source(kernel, self.kernel_arx, ver, 'kernel')
 
     make = f'make-{ver.make}'
-    self.make = self.build / make
     if Version(ver.make) >= Version('4.3'):
       self.make_arx = self.assets / f'{make}.tar.lz'
     else:
       self.make_arx = self.assets / f'{make}.tar.bz2'
+    self.make = self._source(make, self.make_arx, ver, 'make')
 
     mingw = f'mingw-w64-v{ver.mingw}'
-    self.mingw = self.build / mingw
     if Version(ver.mingw).major >= 3:
       self.mingw_arx = self.assets / f'{mingw}.tar.bz2'
     else:
       self.mingw_arx = self.assets / f'{mingw}.tar.gz'
+    self.mingw = self._source(mingw, self.mingw_arx, ver)
 
     mpc = f'mpc-{ver.mpc}'
-    self.mpc = self.build / mpc
     self.mpc_arx = self.assets / f'{mpc}.tar.gz'
+    self.mpc = self._source(mpc, self.mpc_arx, ver)
 
     mpfr = f'mpfr-{ver.mpfr}'
-    self.mpfr = self.build / mpfr
     self.mpfr_arx = self.assets / f'{mpfr}.tar.xz'
+    self.mpfr = self._source(mpfr, self.mpfr_arx, ver)
 
     if ver.python:
       python = f'Python-{ver.python}'
       python_z = f'zlib-{ver.python_z}'
-      self.python = self.build / python
       self.python_arx = self.assets / f'{python}.tar.xz'
-      self.python_z = self.build / python / python_z
       self.python_z_arx = self.assets / f'{python_z}.tar.gz'
+      # built in-tree, named like shared sources so that a changed patch gets a fresh tree
+      key = self._source_key(self.python_arx, ver, 'python', CHECKSUMS[self.python_z_arx.name])
+      self.python = self.build / f'{python}-{key[:12]}'
+      self.python_z = self.python / python_z
     else:
       self.python = None
       self.python_arx = None
@@ -196,3 +229,24 @@ class ProjectPaths:
     self.xmake = self.test / 'xmake'
     self.xmake_arx = self.assets / f'xmake-v{ver.xmake}.win64.zip'
     self.xmake_exe = self.xmake / 'xmake.exe'
+
+  # named by the archive checksum and everything deciding the patches applied to it:
+  # the component's patch directory and `source_inputs`, `prepare_source` itself and profile-dependent choices
+  def _source_key(self, arx: Path, ver: BranchProfile, component: Optional[str] = None, *variant) -> str:
+    return digest(
+      CHECKSUMS[arx.name],
+      patch_dir(component, self.patch) if component else None,
+      source_inputs(component, ver) if component else None,
+      PREPARE_SOURCE,
+      variant,
+    )
+
+  def _source(self, name: str, arx: Path, ver: BranchProfile, component: Optional[str] = None, *variant) -> Path:
+    key = self._source_key(arx, ver, component, *variant)
+    return self.src / f'{name}-{key[:12]}'
+
+  # build directory for (a subdirectory of) a source tree, e.g. `out(paths.gcc, 'build-AAB')`
+  def out(self, src: Path, name: str) -> Path:
+    if src.is_relative_to(self.src):
+      return self.build / src.relative_to(self.src) / name
+    return src / name
@@ -1,16 +1,28 @@
+import argparse
+import ast
+from concurrent.futures import ThreadPoolExecutor
+import inspect
 import logging
 import os
 from packaging.version import Version
 from pathlib import Path
 import shutil
-import subprocess
-
-from module.fetch import validate_and_download, check_and_extract
+from subprocess import STDOUT
+import tempfile
+from typing import Callable, Dict, List, Optional, Tuple
+
+from module import exclude, mirror
+from module.cache import StageCache
+from module.checksum import CHECKSUMS
+from module.fetch import check_and_extract, validate_and_download
+from module.patches import patch_dir, plan, targets
 from module.path import ProjectPaths
-from module.profile import BranchProfile
+from module.profile import BRANCHES, BranchProfile
+from module.util import digest, run
 
 def _patch(path: Path, patch: Path):
-  res = subprocess.run([
+  exclude.check_patch(path, patch)
+  res = run(f'{path.name} (patch {patch.name})', [
     'patch',
     '-Np1',
     '-i', patch,
@@ -21,7 +33,7 @@ def _patch(path: Path, patch: Path):
     raise Exception(message)
 
 def _autoreconf(path: Path):
-  res = subprocess.run([
+  res = run(f'{path.name} (autoreconf)', [
     'autoreconf',
     '-fi',
   ], cwd = path)
@@ -31,7 +43,7 @@ def _autoreconf(path: Path):
     raise Exception(message)
 
 def _automake(path: Path):
-  res = subprocess.run([
+  res = run(f'{path.name} (automake)', [
     'automake',
   ], cwd = path)
   if res.returncode != 0:
@@ -39,138 +51,35 @@ def _automake(path: Path):
     logging.critical(message)
     raise Exception(message)
 
+# extracts a component without the trees in its exclusion manifest
+def _extract(component: str, ver: BranchProfile, path: Path, arx: Path) -> bool:
+  if not check_and_extract(path, arx, exclude.manifest(component, ver, path)):
+    return False
+  exclude.check_tree(path)
+  return True
+
+# applies the patch plan of a component (see `module.patches`)
+def _apply(component: str, ver: BranchProfile, path: Path, paths: ProjectPaths):
+  for patch in plan(component, ver):
+    _patch(path, patch_dir(component, paths.patch) / patch.file)
+
 def _patch_done(path: Path):
   mark = path / '.patched'
   mark.touch()
 
 def _binutils(ver: BranchProfile, paths: ProjectPaths):
-  url = f'https://ftpmirror.gnu.org/gnu/binutils/{paths.binutils_arx.name}'
-  validate_and_download(paths.binutils_arx, url)
-  if check_and_extract(paths.binutils, paths.binutils_arx):
-    v = Version(ver.binutils)
-
-    # Backport
-    if v == Version('2.37'):
-      _patch(paths.binutils, paths.patch / 'binutils' / 'backport_2.37.patch')
-    elif v == Version('2.33.1'):
-      _patch(paths.binutils, paths.patch / 'binutils' / 'backport_2.33.1.patch')
-    elif v == Version('2.27'):
-      _patch(paths.binutils, paths.patch / 'binutils' / 'backport_2.27.patch')
-
-    # Fix path corruption
-    if v >= Version('2.43'):
-      _patch(paths.binutils, paths.patch / 'binutils' / 'fix-path-corruption_2.43.patch')
-    elif v >= Version('2.41'):
-      _patch(paths.binutils, paths.patch / 'binutils' / 'fix-path-corruption_2.41.patch')
-    elif v >= Version('2.39'):
-      _patch(paths.binutils, paths.patch / 'binutils' / 'fix-path-corruption_2.39.patch')
-
-    # Fix elf compress alignment
-    if Version('2.26') <= v < Version('2.32'):
-      if v >= Version('2.30'):
-        _patch(paths.binutils, paths.patch / 'binutils' / 'fix-elf-compress-alignment_2.30.patch')
-      elif v >= Version('2.29'):
-        _patch(paths.binutils, paths.patch / 'binutils' / 'fix-elf-compress-alignment_2.29.patch')
-      else:
-        _patch(paths.binutils, paths.patch / 'binutils' / 'fix-elf-compress-alignment_2.26.patch')
-
-    # Always enable sysroot
-    if v < Version('2.26'):
-      _patch(paths.binutils, paths.patch / 'binutils' / 'always-enable-sysroot.patch')
-
-    # Fix musl locale name
-    if v < Version('2.29.1'):
-      _patch(paths.binutils, paths.patch / 'binutils' / 'fix-musl-locale-name.patch')
-
+  if _extract('binutils', ver, paths.binutils, paths.binutils_arx):
+    _apply('binutils', ver, paths.binutils, paths)
     _patch_done(paths.binutils)
 
 def _gcc(ver: BranchProfile, paths: ProjectPaths):
-  v = Version(ver.gcc)
-  if v.major >= 15:
-    url = f'https://gcc.gnu.org/pub/gcc/snapshots/{ver.gcc}/{paths.gcc_arx.name}'
-  else:
-    url = f'https://ftpmirror.gnu.org/gnu/gcc/gcc-{ver.gcc}/{paths.gcc_arx.name}'
-  validate_and_download(paths.gcc_arx, url)
-  if check_and_extract(paths.gcc, paths.gcc_arx):
-    # Backport
-    if v.major == 11:
-      # - poisoned calloc when building with musl
-      _patch(paths.gcc, paths.patch / 'gcc' / 'backport_11.patch')
-    elif v.major == 10:
-      # - mingw define standard PRI macros when building against musl
-      _patch(paths.gcc, paths.patch / 'gcc' / 'backport_10.patch')
-    elif v.major == 9:
-      # - mingw define standard PRI macros when building against musl
-      _patch(paths.gcc, paths.patch / 'gcc' / 'backport_9.patch')
-    elif v.major == 8:
-      # - gcc fails to find cc1plus if built against ucrt due to a behaviour of `_access`
-      _patch(paths.gcc, paths.patch / 'gcc' / 'backport_8.patch')
-    elif v.major == 7:
-      # - someone declared `bool error_p = NULL`, it works until musl 1.2 defines NULL to nullptr
-      _patch(paths.gcc, paths.patch / 'gcc' / 'backport_7.patch')
-    elif v.major == 6:
-      # - someone declared `bool error_p = NULL`, it works until musl 1.2 defines NULL to nullptr
-      # - intl adds `-liconv` without proper libdir
-      _patch(paths.gcc, paths.patch / 'gcc' / 'backport_6.patch')
-    elif v.major == 5:
-      # - someone declared `bool error_p = NULL`, it works until musl 1.2 defines NULL to nullptr
-      _patch(paths.gcc, paths.patch / 'gcc' / 'backport_5.patch')
-
-    # Fix failure due to language standard evolve
-    if v.major >= 6:
-      pass
-    elif v >= Version('4.9'):
-      _patch(paths.gcc, paths.patch / 'gcc' / 'fix-lang-std_4.9.patch')
-    else:
-      _patch(paths.gcc, paths.patch / 'gcc' / 'fix-lang-std_4.8.patch')
-
-    # Backport `--with-glibc-version``
-    if v == Version('4.8.5'):
-      _patch(paths.gcc, paths.patch / 'gcc' / 'backport-with-glibc-version_4.8.5.patch')
-
-    # Fix libc -> libgcc -> libc dependency
-    if v.major >= 9:
-      _patch(paths.gcc, paths.patch / 'gcc' / 'fix-libc-libgcc-libc-dep_9.patch')
-    elif v.major >= 8:
-      _patch(paths.gcc, paths.patch / 'gcc' / 'fix-libc-libgcc-libc-dep_8.patch')
-    else:
-      _patch(paths.gcc, paths.patch / 'gcc' / 'fix-libc-libgcc-libc-dep_4.8.patch')
-
-    # Fix make variable
-    # - gcc 12 use `override CFLAGS +=` to handle PGO build, which breaks workaround for ucrt `access`
-    if v.major >= 14:
-      _patch(paths.gcc, paths.patch / 'gcc' / 'fix-make-variable_14.patch')
-    elif v.major >= 12:
-      _patch(paths.gcc, paths.patch / 'gcc' / 'fix-make-variable_12.patch')
-
-    # Fix libatomic build
-    if v >= Version('4.8') and v.major < 10:
-      _patch(paths.gcc, paths.patch / 'gcc' / 'fix-libatomic-build.patch')
-
-    # Fix sanitizer dependency of crypt
-    if v.major == 13:
-      _patch(paths.gcc, paths.patch / 'gcc' / 'fix-sanitizer-dep.patch')
-
-    # Fix VT sequence
-    if v.major >= 12:
-      _patch(paths.gcc, paths.patch / 'gcc' / 'fix-vt-seq_12.patch')
-    elif v.major >= 8:
-      _patch(paths.gcc, paths.patch / 'gcc' / 'fix-vt-seq_8.patch')
-
-    # Fix locale directory
-    if v.major >= 12:
-      _patch(paths.gcc, paths.patch / 'gcc' / 'fix-localedir_12.patch')
-    else:
-      _patch(paths.gcc, paths.patch / 'gcc' / 'fix-localedir_4.8.patch')
-
-    # Fix libcpp setlocale
-    # libcpp defines `setlocale` if `HAVE_SETLOCALE` not defined, but its configure.ac does not check `setlocale` at all
-    _patch(paths.gcc, paths.patch / 'gcc' / 'fix-libcpp-setlocale.patch')
+  if _extract('gcc', ver, paths.gcc, paths.gcc_arx):
+    _apply('gcc', ver, paths.gcc, paths)
 
     # Parser-friendly diagnostics
     po_dir = paths.gcc / 'gcc' / 'po'
     po_files = list(po_dir.glob('*.po'))
-    res = subprocess.run([
+    res = run('gcc (sed po)', [
       'sed',
       '-iE',
       '/^msgid "(error|warning): "/,+1 d',
@@ -181,10 +90,6 @@ def _gcc(ver: BranchProfile, paths: ProjectPaths):
       logging.critical(message)
       raise Exception(message)
 
-    # Fix console code page
-    if v.major >= 13:
-      _patch(paths.gcc, paths.patch / 'gcc' / 'fix-console-cp.patch')
-
     # x86_64 use `lib` instead of `lib64`
     filepath = paths.gcc / 'gcc' / 'config' / 'i386' / 't-linux64'
     content = open(filepath).readlines()
@@ -208,151 +113,276 @@ def _gcc(ver: BranchProfile, paths: ProjectPaths):
     _patch_done(paths.gcc)
 
 def _gdb(ver: BranchProfile, paths: ProjectPaths):
-  url = f'https://ftpmirror.gnu.org/gnu/gdb/{paths.gdb_arx.name}'
-  validate_and_download(paths.gdb_arx, url)
-  if check_and_extract(paths.gdb, paths.gdb_arx):
-    v = Version(ver.gdb)
-
-    # Backport
-    if v.major == 10:
-      _patch(paths.gdb, paths.patch / 'gdb' / 'backport_10.patch')
-    elif v == Version('8.3.1'):
-      _patch(paths.gdb, paths.patch / 'gdb' / 'backport_8.3.1.patch')
-    elif v == Version('7.8.2'):
-      _patch(paths.gdb, paths.patch / 'gdb' / 'backport-stub-termcap_7.8.2.patch')
-    elif v == Version('7.6.2'):
-      _patch(paths.gdb, paths.patch / 'gdb' / 'backport-stub-termcap_7.6.2.patch')
-
-    # Fix iconv 'CP65001'
-    _patch(paths.gdb, paths.patch / 'gdb' / 'fix-iconv-cp65001.patch')
-
-    # Fix pythondir
-    if ver.python:
-      _patch(paths.gdb, paths.patch / 'gdb' / 'fix-pythondir.patch')
-
+  if _extract('gdb', ver, paths.gdb, paths.gdb_arx):
+    _apply('gdb', ver, paths.gdb, paths)
     _patch_done(paths.gdb)
 
 def _gettext(ver: BranchProfile, paths: ProjectPaths):
-  url = f'https://ftpmirror.gnu.org/gnu/gettext/{paths.gettext_arx.name}'
-  validate_and_download(paths.gettext_arx, url)
   check_and_extract(paths.gettext, paths.gettext_arx)
   _patch_done(paths.gettext)
 
 def _glibc(ver: BranchProfile, paths: ProjectPaths):
-  url = f'https://ftpmirror.gnu.org/gnu/glibc/{paths.glibc_arx.name}'
-  validate_and_download(paths.glibc_arx, url)
   if check_and_extract(paths.glibc, paths.glibc_arx):
-    v = Version(ver.glibc)
-
-    # Fix make 4.x
-    # glibc locks autoconf version, here we patch configure instead of autoreconf
-    # we do not use make 3.x because it's not easy to build on modern systems
-    if v == Version('2.18'):
-      _patch(paths.glibc, paths.patch / 'glibc' / 'fix-make-4.x_2.18.patch')
-
-    # Disable sunrpc
-    # glibc wrongly implements host tool `rpcgen` as glibc-only
-    # since they finally removed it, we disable it for old versions
-    if v < Version('2.26'):
-      _patch(paths.glibc, paths.patch / 'glibc' / 'disable-sunrpc.patch')
-
+    _apply('glibc', ver, paths.glibc, paths)
     _patch_done(paths.glibc)
 
 def _gmp(ver: BranchProfile, paths: ProjectPaths):
-  url = f'https://ftpmirror.gnu.org/gnu/gmp/{paths.gmp_arx.name}'
-  validate_and_download(paths.gmp_arx, url)
   check_and_extract(paths.gmp, paths.gmp_arx)
   _patch_done(paths.gmp)
 
 def _iconv(ver: BranchProfile, paths: ProjectPaths):
-  url = f'https://ftpmirror.gnu.org/gnu/libiconv/{paths.iconv_arx.name}'
-  validate_and_download(paths.iconv_arx, url)
   check_and_extract(paths.iconv, paths.iconv_arx)
   _patch_done(paths.iconv)
 
 def _kernel(ver: BranchProfile, paths: ProjectPaths):
-  v = Version(ver.kernel)
-  url = f'https://cdn.kernel.org/pub/linux/kernel/v{v.major}.x/{paths.kernel_arx.name}'
-  validate_and_download(paths.kernel_arx, url)
-  if check_and_extract(paths.kernel, paths.kernel_arx):
-    # Fix x86 reloc redefinition
-    if v < Version('3.18'):
-      _patch(paths.kernel, paths.patch / 'linux' / 'fix-x86-reloc-redefinition.patch')
-
+  if _extract('kernel', ver, paths.kernel, paths.kernel_arx):
+    _apply('kernel', ver, paths.kernel, paths)
     _patch_done(paths.kernel)
 
 def _make(ver: BranchProfile, paths: ProjectPaths):
-  url = f'https://ftpmirror.gnu.org/gnu/make/{paths.make_arx.name}'
-  validate_and_download(paths.make_arx, url)
   if check_and_extract(paths.make, paths.make_arx):
-    v = Version(ver.make)
-
-    # Backport
-    if v == Version('4.3'):
-      _patch(paths.make, paths.patch / 'make' / 'backport_4.3.patch')
-
-    # Fix fcntl declaration
-    if v == Version('4.3'):
-      _patch(paths.make, paths.patch / 'make' / 'fix-fcntl-decl.patch')
-
+    _apply('make', ver, paths.make, paths)
     _patch_done(paths.make)
 
 def _mingw(ver: BranchProfile, paths: ProjectPaths):
-  url = f'https://downloads.sourceforge.net/project/mingw-w64/mingw-w64/mingw-w64-release/{paths.mingw_arx.name}'
-  validate_and_download(paths.mingw_arx, url)
   check_and_extract(paths.mingw, paths.mingw_arx)
   _patch_done(paths.mingw)
 
 def _mpc(ver: BranchProfile, paths: ProjectPaths):
-  url = f'https://ftpmirror.gnu.org/gnu/mpc/{paths.mpc_arx.name}'
-  validate_and_download(paths.mpc_arx, url)
   check_and_extract(paths.mpc, paths.mpc_arx)
   _patch_done(paths.mpc)
 
 def _mpfr(ver: BranchProfile, paths: ProjectPaths):
-  url = f'https://ftpmirror.gnu.org/gnu/mpfr/{paths.mpfr_arx.name}'
-  validate_and_download(paths.mpfr_arx, url)
   check_and_extract(paths.mpfr, paths.mpfr_arx)
   _patch_done(paths.mpfr)
 
 def _python(ver: BranchProfile, paths: ProjectPaths):
-  url = f'https://www.python.org/ftp/python/{ver.python}/{paths.python_arx.name}'
-  z_url = f'https://zlib.net/fossils/{paths.python_z_arx.name}'
-  validate_and_download(paths.python_arx, url)
-  validate_and_download(paths.python_z_arx, z_url)
   if check_and_extract(paths.python, paths.python_arx):
-    ver = Version(ver.python)
-
-    # Disable xxlimited shared library if `--disable-test-modules`
-    if ver >= Version('3.12') and ver < Version('3.13'):
-      _patch(paths.python, paths.patch / 'python' / 'disable-shared-xxlimited_3.12.patch')
+    _apply('python', ver, paths.python, paths)
 
     # Alternative build system
     check_and_extract(paths.python_z, paths.python_z_arx)
     os.symlink(paths.python_z, paths.python / 'zlib', target_is_directory = True)
-    if ver >= Version('3.13'):
+    if Version(ver.python) >= Version('3.13'):
       shutil.copy(paths.patch / 'python' / 'xmake_3.13.lua', paths.python / 'xmake.lua')
-      _patch(paths.python, paths.patch / 'python' / 'fix-mingw-build_3.13.patch')
     else:
       shutil.copy(paths.patch / 'python' / 'xmake_3.12.lua', paths.python / 'xmake.lua')
-      _patch(paths.python, paths.patch / 'python' / 'fix-mingw-build_3.12.patch')
     shutil.copy(paths.patch / 'python' / 'python-config.sh', paths.python / 'python-config.sh')
 
     _patch_done(paths.python)
 
-def prepare_source(ver: BranchProfile, paths: ProjectPaths):
-  _binutils(ver, paths)
-  _gcc(ver, paths)
-  _gdb(ver, paths)
+# archives of every component with their source family and path on its mirrors (see `module.mirror`)
+def sources(ver: BranchProfile, paths: ProjectPaths) -> Dict[str, List[Tuple[Path, str, str]]]:
+  if Version(ver.gcc).major >= 15:
+    gcc = (paths.gcc_arx, 'gcc-snapshot', f'{ver.gcc}/{paths.gcc_arx.name}')
+  else:
+    gcc = (paths.gcc_arx, 'gnu', f'gcc/gcc-{ver.gcc}/{paths.gcc_arx.name}')
+  result = {
+    'binutils': [(paths.binutils_arx, 'gnu', f'binutils/{paths.binutils_arx.name}')],
+    'gcc': [gcc],
+    'gdb': [(paths.gdb_arx, 'gnu', f'gdb/{paths.gdb_arx.name}')],
+    'glibc': [(paths.glibc_arx, 'gnu', f'glibc/{paths.glibc_arx.name}')],
+    'gmp': [(paths.gmp_arx, 'gnu', f'gmp/{paths.gmp_arx.name}')],
+    'iconv': [(paths.iconv_arx, 'gnu', f'libiconv/{paths.iconv_arx.name}')],
+    'kernel': [(paths.kernel_arx, 'kernel', f'v{Version(ver.kernel).major}.x/{paths.kernel_arx.name}')],
+    'make': [(paths.make_arx, 'gnu', f'make/{paths.make_arx.name}')],
+    'mingw': [(paths.mingw_arx, 'sourceforge', f'mingw-w64/mingw-w64/mingw-w64-release/{paths.mingw_arx.name}')],
+    'mpc': [(paths.mpc_arx, 'gnu', f'mpc/{paths.mpc_arx.name}')],
+    'mpfr': [(paths.mpfr_arx, 'gnu', f'mpfr/{paths.mpfr_arx.name}')],
+  }
   if ver.gettext:
-    _gettext(ver, paths)
-  _glibc(ver, paths)
-  _gmp(ver, paths)
-  _iconv(ver, paths)
-  _kernel(ver, paths)
-  _make(ver, paths)
-  _mingw(ver, paths)
-  _mpc(ver, paths)
-  _mpfr(ver, paths)
+    result['gettext'] = [(paths.gettext_arx, 'gnu', f'gettext/{paths.gettext_arx.name}')]
   if ver.python:
-    _python(ver, paths)
+    result['python'] = [
+      (paths.python_arx, 'python', f'{ver.python}/{paths.python_arx.name}'),
+      (paths.python_z_arx, 'zlib', paths.python_z_arx.name),
+    ]
+  return result
+
+PREPARE = {
+  'binutils': _binutils,
+  'gcc': _gcc,
+  'gdb': _gdb,
+  'gettext': _gettext,
+  'glibc': _glibc,
+  'gmp': _gmp,
+  'iconv': _iconv,
+  'kernel': _kernel,
+  'make': _make,
+  'mingw': _mingw,
+  'mpc': _mpc,
+  'mpfr': _mpfr,
+  'python': _python,
+}
+
+# source trees of a component, `python` links to its zlib by absolute path
+def _trees(component: str, paths: ProjectPaths) -> List[Path]:
+  if component == 'python':
+    return [paths.python, paths.python_z]
+  return [getattr(paths, component)]
+
+# profile fields read by a prepare function, e.g. `ver.gdb` and `ver.python` of `_gdb`
+def _fields(function: Callable) -> List[str]:
+  tree = ast.parse(inspect.getsource(function))
+  return sorted({
+    node.attr
+    for node in ast.walk(tree)
+    if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and node.value.id == 'ver'
+  })
+
+# everything that ends up in the patched trees: upstream archives, excluded trees,
+# the patch plan and the prepare function itself (in-place edits, and files copied from the patch directory)
+def _snapshot_keys(component: str, ver: BranchProfile, paths: ProjectPaths) -> List[str]:
+  function = PREPARE[component]
+  key = digest(
+    'source',
+    component,
+    [CHECKSUMS[arx.name] for arx, _, _ in sources(ver, paths)[component]],
+    [(field, getattr(ver, field)) for field in _fields(function)],
+    exclude.EXCLUDES[component](ver) if component in exclude.EXCLUDES else [],
+    [(patch.file, patch_dir(component, paths.patch) / patch.file) for patch in plan(component, ver)],
+    sorted(file for file in patch_dir(component, paths.patch).glob('*') if file.suffix != '.patch'),
+    inspect.getsource(function),
+    [str(tree) for tree in _trees(component, paths)],
+  )
+  return [digest(key, tree.name) for tree in _trees(component, paths)]
+
+# a component not prepared yet, with snapshots of all its trees in `cache`, needs no archives
+def restorable(component: str, ver: BranchProfile, paths: ProjectPaths, cache: Optional[StageCache]) -> bool:
+  if cache is None or any(tree.exists() for tree in _trees(component, paths)):
+    return False
+  return all(cache.contains(key) for key in _snapshot_keys(component, ver, paths))
+
+def _restore(component: str, ver: BranchProfile, paths: ProjectPaths, cache: StageCache) -> bool:
+  trees = _trees(component, paths)
+  try:
+    for key, tree in zip(_snapshot_keys(component, ver, paths), trees):
+      cache.restore(key, tree)
+    return True
+  except Exception as e:
+    logging.warning('Snapshot fail: restoring %s (%s), preparing it from its archives', component, e)
+    for tree in trees:
+      if tree.exists():
+        shutil.rmtree(tree)
+    return False
+
+# extracts and patches a component of `sources`, its archives must have been downloaded.
+# with a `cache`, patched trees are snapshotted, and restored instead of extracted and patched again.
+# `restore` is decided while planning (see `restorable`), when the archives are not fetched:
+# if the snapshots are gone by the time the stage runs, `download` fetches them first.
+def prepare_component(
+  component: str,
+  ver: BranchProfile,
+  paths: ProjectPaths,
+  cache: Optional[StageCache] = None,
+  restore: bool = False,
+  download: Optional[Callable[[], None]] = None,
+):
+  trees = _trees(component, paths)
+  # another branch may have prepared the trees meanwhile
+  if restore and not any(tree.exists() for tree in trees):
+    if _restore(component, ver, paths, cache):
+      return
+    download()
+
+  fresh = not any(tree.exists() for tree in trees)
+  PREPARE[component](ver, paths)
+  if cache is not None and fresh:
+    for key, tree in zip(_snapshot_keys(component, ver, paths), trees):
+      cache.store(key, tree)
+
+# `--check-patches`: tries the patch plans of the branches on pristine sources, concurrently.
+# a plan is checked once for all branches sharing it: only the files it touches are extracted
+# to a scratch directory, and every patch is dry-run, then applied for the next ones.
+def _check_plan(config: argparse.Namespace, component: str, ver: BranchProfile, paths: ProjectPaths) -> List[Tuple[str, Optional[str]]]:
+  arx, family, path = sources(ver, paths)[component][0]
+  validate_and_download(
+    arx,
+    mirror.urls(family, path),
+    retry = config.download_retry,
+    backoff = config.download_backoff,
+    paranoid = config.paranoid,
+    store = Path(config.asset_store).expanduser() if config.asset_store else None,
+  )
+  patches = [patch_dir(component, paths.patch) / patch.file for patch in plan(component, ver)]
+
+  # files of the archive touched by the plan, except those created by earlier patches
+  members = []
+  created = set()
+  for patch in patches:
+    for old, new in targets(patch):
+      if old is None:
+        created.add(new)
+      elif old not in created and str(old) not in members:
+        members.append(str(old))
+
+  results: List[Tuple[str, Optional[str]]] = []
+  with tempfile.TemporaryDirectory(prefix = 'check-patches-') as scratch:
+    tree = Path(scratch) / arx.name
+    check_and_extract(tree, arx, exclude.manifest(component, ver, tree), members)
+    for patch in patches:
+      try:
+        exclude.check_patch(tree, patch)
+      except Exception as e:
+        results.append((patch.name, str(e)))
+        break
+      log = Path(scratch) / f'{patch.name}.log'
+      with open(log, 'wb') as f:
+        res = run(f'{arx.name} (dry-run {patch.name})', [
+          'patch',
+          '--dry-run',
+          '-Np1',
+          '-i', patch,
+        ], cwd = tree, stdout = f, stderr = STDOUT)
+      if res.returncode != 0:
+        results.append((patch.name, log.read_text(errors = 'replace')))
+        break
+      with open(log, 'wb') as f:
+        run(f'{arx.name} (patch {patch.name})', [
+          'patch',
+          '-Np1',
+          '-i', patch,
+        ], cwd = tree, stdout = f, stderr = STDOUT)
+      results.append((patch.name, None))
+  # later patches may depend on the failed one
+  results += [(patch.name, 'not tried') for patch in patches[len(results):]]
+  return results
+
+def check_patches(config: argparse.Namespace) -> bool:
+  checks: Dict[Tuple[str, str, Tuple[str, ...]], Tuple[BranchProfile, ProjectPaths, List[str]]] = {}
+  for branch in config.branches:
+    ver = BRANCHES[branch]
+    paths = ProjectPaths(argparse.Namespace(**{**vars(config), 'branch': branch}), ver)
+    for component, items in sources(ver, paths).items():
+      files = tuple(patch.file for patch in plan(component, ver))
+      if files:
+        key = (component, items[0][0].name, files)
+        checks.setdefault(key, (ver, paths, []))[2].append(branch)
+
+  mirror.rank([
+    sources(ver, paths)[component][0]
+    for (component, _, _), (ver, paths, _) in checks.items()
+  ], config.mirrors)
+
+  pool = ThreadPoolExecutor(max_workers = max(config.jobs, 1))
+  futures = {
+    key: pool.submit(_check_plan, config, key[0], ver, paths)
+    for key, (ver, paths, _) in checks.items()
+  }
+  ok = True
+  for key, future in futures.items():
+    component, name, _ = key
+    branches = checks[key][2]
+    try:
+      results = future.result()
+    except Exception as e:
+      results = [('(fetch and extract)', str(e))]
+    print(f'{name} (branches {", ".join(branches)}):')
+    for patch, error in results:
+      print(f'  {"ok" if error is None else "FAIL":4}  {patch}')
+      if error is not None:
+        ok = False
+        for line in error.rstrip().splitlines():
+          print(f'        {line}')
+  pool.shutdown()
+  return ok
@@ -28,7 +28,7 @@ def _gcc_mingw(ver: BranchProfile, paths: ProjectPaths):
 
 def _xmake(ver: BranchProfile, paths: ProjectPaths):
   url = f'https://github.com/xmake-io/xmake/releases/download/v{ver.xmake}/{paths.xmake_arx.name}'
-  validate_and_download(paths.xmake_arx, url)
+  validate_and_download(paths.xmake_arx, [url])
   check_and_extract(paths.xmake, paths.xmake_arx)
   paths.xmake_exe.chmod(0o755)
   (paths.xmake / '.patched').touch()
@@ -0,0 +1,92 @@
+import os
+import sys
+import time
+from typing import Dict, TextIO
+
+from module.stage import StageGraph
+
+# `--progress`: a status line of completed / running stages and the ETA,
+# from stage durations of previous runs (see `history.predict`).
+# the ETA is the longest remaining path through the graph, so it assumes enough jobs to run
+# independent stages side by side; stages without history count as instant.
+
+# interval of status lines when not writing to a terminal
+LOG_INTERVAL = 60
+
+def _duration(seconds: float) -> str:
+  seconds = int(seconds)
+  return f'{seconds // 3600}:{seconds // 60 % 60:02}:{seconds % 60:02}'
+
+class Progress:
+  graph: StageGraph
+  predicted: Dict[str, float]
+  started: float
+  running: Dict[str, float]
+  done: set
+  total: int
+  out: TextIO
+  tty: bool
+  last: float
+
+  def __init__(self, graph: StageGraph, predicted: Dict[str, float], out: TextIO = sys.stderr):
+    self.graph = graph
+    self.predicted = predicted
+    self.started = time.time()
+    self.running = {}
+    self.done = set()
+    self.total = sum(1 for stage in graph.stages.values() if stage.action is not None)
+    self.out = out
+    self.tty = out.isatty()
+    self.last = 0
+
+  def start(self, name: str):
+    self.running[name] = time.time()
+    self.show()
+
+  def finish(self, name: str):
+    self.running.pop(name, None)
+    if self.graph.stages[name].action is not None:
+      self.done.add(name)
+    self.show()
+
+  def eta(self) -> float:
+    now = time.time()
+    finish: Dict[str, float] = {}
+    # stages are in declaration order, dependencies come first
+    for name, stage in self.graph.stages.items():
+      if name in self.done:
+        finish[name] = 0
+        continue
+      after = max((finish[dep] for dep in stage.deps), default = 0)
+      expected = self.predicted.get(name, 0) if stage.action is not None else 0
+      if name in self.running:
+        expected = max(expected - (now - self.running[name]), 0)
+      finish[name] = after + expected
+    return max(finish.values(), default = 0)
+
+  def show(self, force: bool = False):
+    now = time.time()
+    if not self.tty and not force and now - self.last < LOG_INTERVAL:
+      return
+    self.last = now
+    unknown = sum(1 for name in self.graph.stages if name not in self.predicted and name not in self.done and self.graph.stages[name].action is not None)
+    line = f'[{len(self.done)}/{self.total}] elapsed {_duration(now - self.started)}, ETA {_duration(self.eta())}'
+    if unknown:
+      line += f' (+{unknown} stages without history)'
+    if self.running:
+      line += ', running: ' + ', '.join(self.running)
+    if self.tty:
+      try:
+        columns = os.get_terminal_size(self.out.fileno()).columns
+      except OSError:
+        columns = 200
+      self.out.write(f'\r\x1b[K{line[:columns - 1]}')
+    else:
+      self.out.write(f'{line}\n')
+    self.out.flush()
+
+  def close(self):
+    self.show(force = True)
+    if self.tty:
+      self.out.write('\n')
+      self.out.flush()
@@ -0,0 +1,78 @@
+import json
+from pathlib import Path
+import threading
+import time
+from typing import Dict, List, Optional
+
+# resource usage of a branch's build, written to `dist/build-report-{branch}.json`:
+# - stages: wall clock span of every stage that ran
+# - steps: every subprocess (configure, make, patch, ...) with its process tree's rusage from `wait4`,
+#   and in-process steps like downloads
+# times are in seconds since the start of the run.
+class BuildReport:
+  branch: str
+  path: Path
+  started: float
+  stages: List[Dict]
+  steps: List[Dict]
+  lock: threading.Lock
+
+  def __init__(self, branch: str, path: Path):
+    self.branch = branch
+    self.path = path
+    self.started = time.time()
+    self.stages = []
+    self.steps = []
+    self.lock = threading.Lock()
+
+  def add_stage(self, name: str, start: float, end: float, ok: bool):
+    with self.lock:
+      self.stages.append({
+        'name': name,
+        'start': round(start - self.started, 3),
+        'wall': round(end - start, 3),
+        'ok': ok,
+      })
+
+  # `rusage` is None for steps done in-process (e.g. download)
+  def add_step(self, stage: Optional[str], step: str, command: str, start: float, end: float, returncode: int, rusage):
+    record = {
+      'stage': stage,
+      'step': step,
+      'command': command,
+      'start': round(start - self.started, 3),
+      'wall': round(end - start, 3),
+      'user': None,
+      'sys': None,
+      'max_rss': None,
+      'in_blocks': None,
+      'out_blocks': None,
+      'returncode': returncode,
+    }
+    if rusage is not None:
+      record.update({
+        'user': round(rusage.ru_utime, 3),
+        'sys': round(rusage.ru_stime, 3),
+        # kilobytes on linux
+        'max_rss': rusage.ru_maxrss,
+        'in_blocks': rusage.ru_inblock,
+        'out_blocks': rusage.ru_oublock,
+      })
+    with self.lock:
+      self.steps.append(record)
+
+  def write(self):
+    with self.lock:
+      stages = sorted(self.stages, key = lambda stage: stage['start'])
+      steps = sorted(self.steps, key = lambda step: step['start'])
+      report = {
+        'branch': self.branch,
+        'started': self.started,
+        'wall': round(time.time() - self.started, 3),
+        'cpu': round(sum(step['user'] + step['sys'] for step in steps if step['user'] is not None), 3),
+        'stages': stages,
+        'steps': steps,
+      }
+    self.path.parent.mkdir(parents = True, exist_ok = True)
+    with open(self.path, 'w') as f:
+      json.dump(report, f, indent = 2)
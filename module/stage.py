@@ -0,0 +1,337 @@
+import ast
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from copy import copy
+import inspect
+import logging
+from pathlib import Path, PurePath
+import re
+import textwrap
+import time
+from types import CodeType, FunctionType
+from typing import TYPE_CHECKING, Callable, Dict, Iterator, List, Optional, Tuple
+
+from module import jobserver
+from module.cache import StageCache
+from module.path import ProjectPaths
+from module.profile import BranchProfile
+from module.report import BuildReport
+from module.util import digest, stage_context
+
+if TYPE_CHECKING:
+  from module.progress import Progress
+
+class Stage:
+  name: str
+  action: Optional[Callable[[], None]]
+  deps: List[str]
+  lock: Optional[str]
+  stamp_path: Optional[Path]
+  stamp_key: str
+  env: Optional[Dict[str, str]]
+  report: Optional[BuildReport]
+
+  def __init__(
+    self,
+    name: str,
+    action: Optional[Callable[[], None]],
+    deps: List[str],
+    lock: Optional[str],
+    stamp_path: Optional[Path],
+    stamp_key: str,
+    env: Optional[Dict[str, str]],
+    report: Optional[BuildReport],
+  ):
+    self.name = name
+    self.action = action
+    self.deps = deps
+    self.lock = lock
+    self.stamp_path = stamp_path
+    self.stamp_key = stamp_key
+    self.env = env
+    self.report = report
+
+# per-architecture values (e.g. `paths.linux_prefix`, `ver.enable_kernel`) are keyed for all architectures
+ARCHES = ['x86_64', 'aarch64']
+
+def _value(value):
+  if isinstance(value, PurePath):
+    return str(value)
+  # e.g. `paths.out`, whose result depends on its arguments
+  if inspect.ismethod(value):
+    return None
+  if callable(value):
+    return {arch: _value(value(arch)) for arch in ARCHES}
+  return value
+
+def _names(code: CodeType) -> Iterator[str]:
+  yield from code.co_names
+  for const in code.co_consts:
+    if isinstance(const, CodeType):
+      yield from _names(const)
+
+# step functions called by `action`, followed through functions of the same module
+def _functions(action: Callable[[], None]) -> List[FunctionType]:
+  result = [action]
+  for function in result:
+    for name in _names(function.__code__):
+      value = function.__globals__.get(name)
+      if isinstance(value, FunctionType) and value.__module__ == action.__module__ and value not in result:
+        result.append(value)
+  return result
+
+def _source(function: FunctionType) -> str:
+  try:
+    return inspect.getsource(function)
+  except OSError:
+    return function.__code__.co_code.hex()
+
+# `ver.<field>` and `paths.<attr>` read by a function
+def _reads(function: FunctionType) -> Iterator[Tuple[str, str]]:
+  if function.__name__ == '<lambda>':
+    return
+  for node in ast.walk(ast.parse(textwrap.dedent(_source(function)))):
+    if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and node.value.id in ['ver', 'paths']:
+      yield node.value.id, node.attr
+
+# what the output of an action depends on besides the scope's fingerprint, found in the step functions
+# it calls: their source and module constants, the profile fields and paths they read, and the plain
+# values the action captures (e.g. `arch`, a cache key). source trees are named by everything deciding
+# their contents (see `ProjectPaths._source`), so a changed patch reruns the stages reading its tree.
+def _inputs(action: Optional[Callable[[], None]], shared: bool = False) -> List:
+  if action is None:
+    return []
+  values = [cell.cell_contents for cell in action.__closure__ or []] + list(action.__defaults__ or [])
+  objects = {'ver': BranchProfile, 'paths': ProjectPaths}
+  # paths of a shared stage may be those of the branch declaring it (e.g. its python tree), its key names their versions
+  if shared:
+    del objects['paths']
+  objects = {name: next((value for value in values if isinstance(value, kind)), None) for name, kind in objects.items()}
+  functions = _functions(action)
+  reads = sorted({read for function in functions for read in _reads(function)})
+  constants = sorted({
+    (name, repr(function.__globals__[name]))
+    for function in functions
+    for name in _names(function.__code__)
+    if isinstance(function.__globals__.get(name), (str, int, float, bool, list, tuple, dict))
+  })
+  return [
+    [_source(function) for function in functions],
+    constants,
+    [(kind, attr, _value(getattr(objects[kind], attr, None))) for kind, attr in reads if objects.get(kind) is not None],
+    [_value(value) for value in values if isinstance(value, (str, int, float, bool, PurePath))],
+  ]
+
+# a graph is planned through scopes: every branch declares its stages in its own scope
+# (name prefix, stamp directory, environment, report), all scopes share the same stages.
+class StageGraph:
+  stages: Dict[str, Stage]
+
+  prefix: str
+  env: Optional[Dict[str, str]]
+  report: Optional[BuildReport]
+
+  # completed stages leave a stamp keyed on their arguments (`fingerprint` and `_inputs`) and the stamp keys
+  # of their dependencies in `stamp_dir`, a rerun skips them unless a dependency had to be rebuilt
+  stamp_dir: Optional[Path]
+  fingerprint: str
+
+  cache: Optional[StageCache]
+
+  # stages shared between scopes, by key, see `shared`
+  shared_stamp_dir: Optional[Path]
+  once: Dict[str, str]
+  # in a shared scope, dependencies declared by other scopes are named by `fingerprint` (the key)
+  shared_scope: bool
+
+  def __init__(
+    self,
+    stamp_dir: Optional[Path] = None,
+    fingerprint: str = '',
+    cache: Optional[StageCache] = None,
+    shared_stamp_dir: Optional[Path] = None,
+  ):
+    self.stages = {}
+    self.prefix = ''
+    self.env = None
+    self.report = None
+    self.stamp_dir = stamp_dir
+    self.fingerprint = fingerprint
+    self.cache = cache
+    self.shared_stamp_dir = shared_stamp_dir
+    self.once = {}
+    self.shared_scope = False
+
+  def scope(
+    self,
+    prefix: str = '',
+    stamp_dir: Optional[Path] = None,
+    fingerprint: str = '',
+    env: Optional[Dict[str, str]] = None,
+    report: Optional[BuildReport] = None,
+  ) -> 'StageGraph':
+    scope = copy(self)
+    scope.prefix = prefix
+    scope.stamp_dir = stamp_dir
+    scope.fingerprint = fingerprint
+    scope.env = env
+    scope.report = report
+    scope.shared_scope = False
+    return scope
+
+  # `action = None` declares a join point that only waits for its dependencies.
+  # stages sharing the same `lock` never run at the same time (e.g. a global symlink).
+  # `stamp = False` for idempotent stages that should always run (e.g. checksum validation).
+  def add(
+    self,
+    name: str,
+    action: Optional[Callable[[], None]],
+    deps: List[str] = [],
+    lock: Optional[str] = None,
+    stamp: bool = True,
+  ) -> str:
+    scoped = self.prefix + name
+    if scoped in self.stages:
+      raise Exception('Stage fail: %s declared twice' % scoped)
+    for dep in deps:
+      if dep not in self.stages:
+        raise Exception('Stage fail: %s depends on undeclared stage %s' % (scoped, dep))
+    stamp_path = None
+    if self.stamp_dir is not None and stamp:
+      slug = re.sub(r'[^0-9A-Za-z._-]+', '_', name)
+      stamp_path = self.stamp_dir / f'{slug}.stamp'
+    # stages always running (fetch, prepare) are not part of their dependents' keys,
+    # what they make is (e.g. the names of source trees)
+    stamp_key = ''
+    if stamp:
+      chained = [dep for dep in deps if not self.shared_scope or dep.startswith(self.prefix)]
+      stamp_key = digest(name, self.fingerprint, _inputs(action, self.shared_scope), [self.stages[dep].stamp_key for dep in chained])
+    self.stages[scoped] = Stage(scoped, action, list(deps), lock, stamp_path, stamp_key, self.env, self.report)
+    return scoped
+
+  # stages whose output does not depend on the scope (e.g. host libraries of the same versions)
+  # are declared by the first scope asking for `key`, later scopes get the same stages.
+  # `key` must name everything the output depends on, it is also the stamp.
+  def shared(self, key: str, declare: Callable[['StageGraph'], str]) -> str:
+    if key not in self.once:
+      stamp_dir = None
+      if self.shared_stamp_dir is not None:
+        stamp_dir = self.shared_stamp_dir / re.sub(r'[^0-9A-Za-z._-]+', '_', key)
+      scope = self.scope(f'[{key}] ', stamp_dir, key, self.env, self.report)
+      scope.shared_scope = True
+      self.once[key] = declare(scope)
+    return self.once[key]
+
+  # a cached output is restored by a single stage instead of the stages building it.
+  # the decision is made while planning, so a hit removes the whole group from the graph.
+  def restore(self, name: str, key: str, output: Path, deps: List[str]) -> Optional[str]:
+    if self.cache is None or not self.cache.contains(key):
+      return None
+    return self.add(f'{name} (restore)', lambda: self.cache.restore(key, output), deps)
+
+  def store(self, name: str, key: str, output: Path, deps: List[str]) -> str:
+    if self.cache is None:
+      return self.add(name, None, deps)
+    return self.add(f'{name} (store)', lambda: self.cache.store(key, output), deps)
+
+  def cached(self, name: str, key: str, output: Path, deps: List[str], declare: Callable[[List[str]], str]) -> str:
+    restored = self.restore(name, key, output, deps)
+    if restored is not None:
+      return restored
+    return self.store(name, key, output, [declare(deps)])
+
+  def _stamped(self, stage: Stage) -> bool:
+    if stage.stamp_path is None:
+      return False
+    return stage.stamp_path.exists() and stage.stamp_path.read_text().strip() == stage.stamp_key
+
+  def _mark(self, stage: Stage):
+    if stage.stamp_path is None:
+      return
+    stage.stamp_path.parent.mkdir(parents = True, exist_ok = True)
+    stage.stamp_path.write_text(stage.stamp_key + '\n')
+
+  def _ready(self, stage: Stage, done: set, locked: set) -> bool:
+    if stage.lock is not None and stage.lock in locked:
+      return False
+    return all(dep in done for dep in stage.deps)
+
+  def _run_stage(self, stage: Stage):
+    # the token stands for the first job of the stage's make, see `module.jobserver`
+    with jobserver.token(), stage_context(stage.name, stage.env, stage.report):
+      logging.info('Stage start: %s', stage.name)
+      start = time.time()
+      ok = False
+      try:
+        stage.action()
+        ok = True
+      finally:
+        if stage.report is not None:
+          stage.report.add_stage(stage.name, start, time.time(), ok)
+      logging.info('Stage done: %s', stage.name)
+    self._mark(stage)
+
+  def run(self, workers: int, progress: Optional['Progress'] = None):
+    # stages are picked in declaration order, so declare the critical path first
+    pending = dict(self.stages)
+    done = set()
+    # stamped stages that actually ran in this invocation, their dependents must rerun
+    rebuilt = set()
+    locked = set()
+    running: Dict[Future, Stage] = {}
+    failure: Optional[BaseException] = None
+
+    with ThreadPoolExecutor(max_workers = max(workers, 1)) as pool:
+      while True:
+        scheduled = failure is None
+        while scheduled:
+          scheduled = False
+          for stage in list(pending.values()):
+            if len(running) >= max(workers, 1):
+              break
+            if not self._ready(stage, done, locked):
+              continue
+            del pending[stage.name]
+            scheduled = True
+            dirty = any(dep in rebuilt for dep in stage.deps)
+            if stage.action is None:
+              done.add(stage.name)
+              if dirty:
+                rebuilt.add(stage.name)
+              continue
+            if not dirty and self._stamped(stage):
+              logging.info('Stage skip: %s (stamped)', stage.name)
+              done.add(stage.name)
+              if progress is not None:
+                progress.finish(stage.name)
+              continue
+            if stage.lock is not None:
+              locked.add(stage.lock)
+            running[pool.submit(self._run_stage, stage)] = stage
+            if progress is not None:
+              progress.start(stage.name)
+
+        if not running:
+          break
+
+        # with progress, wake up every second to refresh it
+        finished, _ = wait(running, timeout = 1 if progress is not None else None, return_when = FIRST_COMPLETED)
+        if progress is not None and not finished:
+          progress.show()
+        for future in finished:
+          stage = running.pop(future)
+          if stage.lock is not None:
+            locked.discard(stage.lock)
+          error = future.exception()
+          if error is None:
+            done.add(stage.name)
+            if stage.stamp_path is not None:
+              rebuilt.add(stage.name)
+            if progress is not None:
+              progress.finish(stage.name)
+          else:
+            logging.critical('Stage fail: %s', stage.name)
+            if failure is None:
+              failure = error
+
+    if failure is not None:
+      raise failure
@@ -0,0 +1,83 @@
+import json
+from pathlib import Path
+from typing import Dict, List
+
+from module.report import BuildReport
+
+# `--trace`: chrome trace event format, open with https://ui.perfetto.dev or chrome://tracing.
+# stages of all branches are packed into lanes, one lane per concurrently running stage,
+# their steps (download, extract, patch, configure, make, ...) nest below them.
+
+def _us(seconds: float) -> int:
+  return round(seconds * 1_000_000)
+
+def _lanes(spans: List[Dict]) -> List[int]:
+  ends: List[float] = []
+  result = []
+  for span in spans:
+    for lane, end in enumerate(ends):
+      if end <= span['start']:
+        break
+    else:
+      lane = len(ends)
+      ends.append(0)
+    ends[lane] = span['end']
+    result.append(lane)
+  return result
+
+def write_trace(reports: List[BuildReport], path: Path):
+  origin = min(report.started for report in reports)
+  stages = []
+  steps: Dict[str, List[Dict]] = {}
+  for report in reports:
+    offset = report.started - origin
+    with report.lock:
+      for stage in report.stages:
+        stages.append({
+          **stage,
+          'branch': report.branch,
+          'start': offset + stage['start'],
+          'end': offset + stage['start'] + stage['wall'],
+        })
+      for step in report.steps:
+        steps.setdefault(step['stage'], []).append({
+          **step,
+          'start': offset + step['start'],
+          'end': offset + step['start'] + step['wall'],
+        })
+  stages.sort(key = lambda stage: stage['start'])
+
+  events = [{'name': 'process_name', 'ph': 'M', 'pid': 1, 'args': {'name': 'build'}}]
+  lanes = _lanes(stages)
+  for lane in sorted(set(lanes)):
+    events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': lane, 'args': {'name': f'lane {lane}'}})
+  for stage, lane in zip(stages, lanes):
+    events.append({
+      'name': stage['name'],
+      'cat': 'stage',
+      'ph': 'X',
+      'pid': 1,
+      'tid': lane,
+      'ts': _us(stage['start']),
+      'dur': _us(stage['wall']),
+      'args': {'branch': stage['branch'], 'ok': stage['ok']},
+    })
+    for step in steps.get(stage['name'], []):
+      # clamp rounding errors, so that the step nests in its stage
+      start = max(step['start'], stage['start'])
+      end = min(step['end'], stage['end'])
+      args = {key: step[key] for key in ['command', 'user', 'sys', 'max_rss', 'returncode'] if step[key] is not None}
+      events.append({
+        'name': step['step'],
+        'cat': step['command'],
+        'ph': 'X',
+        'pid': 1,
+        'tid': lane,
+        'ts': _us(start),
+        'dur': _us(max(end - start, 0)),
+        'args': args,
+      })
+
+  path.parent.mkdir(parents = True, exist_ok = True)
+  with open(path, 'w') as f:
+    json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
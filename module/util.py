@@ -1,10 +1,101 @@
 from contextlib import contextmanager
+from hashlib import sha256
 import logging
 import os
 from pathlib import Path
 import re
-import subprocess
-from typing import List
+from subprocess import STDOUT, CompletedProcess, Popen
+import threading
+import time
+from typing import Dict, Iterator, List, Optional
+
+from module import ccache, jobserver
+from module.report import BuildReport
+
+# the running stage: its name, environment (e.g. `PATH` of its branch) and report,
+# see `StageGraph.scope`
+_stage = threading.local()
+
+@contextmanager
+def stage_context(name: str, env: Optional[Dict[str, str]], report: Optional[BuildReport]) -> Iterator[None]:
+  if env is not None:
+    ccache.masquerade(env)
+  _stage.name = name
+  _stage.env = env
+  _stage.report = report
+  try:
+    yield
+  finally:
+    _stage.name = None
+    _stage.env = None
+    _stage.report = None
+
+# with `--progress`, output of build steps goes to `<log_dir>/<branch>/<stage>/<step>.log`
+_log_dir: Optional[Path] = None
+
+def log_to(log_dir: Optional[Path]):
+  global _log_dir
+  _log_dir = log_dir
+
+def _slug(name: str) -> str:
+  return re.sub(r'[^0-9A-Za-z._-]+', '_', name).strip('_')
+
+def _log_path(step: str) -> Optional[Path]:
+  report = getattr(_stage, 'report', None)
+  if _log_dir is None or report is None:
+    return None
+  stage = _stage.name.removeprefix(f'[{report.branch}] ')
+  return _log_dir / report.branch / _slug(stage) / f'{_slug(step)}.log'
+
+def environ() -> Dict[str, str]:
+  env = getattr(_stage, 'env', None)
+  return dict(env if env is not None else os.environ)
+
+# subprocesses of build steps go through `popen`/`wait` (or `run`),
+# which account the resource usage of the whole process tree to the stage's report
+def popen(args: List, step: Optional[str] = None, **kwargs) -> Popen:
+  log = _log_path(step or os.path.basename(str(args[0])))
+  if log is None or ('stdout' in kwargs and 'stderr' in kwargs):
+    process = Popen(args, **kwargs)
+    process.log = None
+  else:
+    log.parent.mkdir(parents = True, exist_ok = True)
+    with open(log, 'ab') as f:
+      if 'stdout' not in kwargs:
+        kwargs['stdout'] = f
+        kwargs.setdefault('stderr', STDOUT)
+      else:
+        kwargs['stderr'] = f
+      process = Popen(args, **kwargs)
+    process.log = log
+  process.started = time.time()
+  return process
+
+def wait(step: str, process: Popen) -> int:
+  _, status, rusage = os.wait4(process.pid, 0)
+  process.returncode = os.waitstatus_to_exitcode(status)
+  if process.returncode != 0 and process.log is not None:
+    logging.critical('Step fail: %s, see %s', step, process.log)
+  report = getattr(_stage, 'report', None)
+  if report is not None:
+    report.add_step(_stage.name, step, os.path.basename(str(process.args[0])), process.started, time.time(), process.returncode, rusage)
+  return process.returncode
+
+def run(step: str, args: List, **kwargs) -> CompletedProcess:
+  return CompletedProcess(args, wait(step, popen(args, step = step, **kwargs)))
+
+# in-process steps (e.g. download) are only timed
+@contextmanager
+def timed(step: str, command: str) -> Iterator[None]:
+  start = time.time()
+  returncode = 1
+  try:
+    yield
+    returncode = 0
+  finally:
+    report = getattr(_stage, 'report', None)
+    if report is not None:
+      report.add_step(_stage.name, step, command, start, time.time(), returncode, None)
 
 def cflags_A(
   suffix: str = '',
@@ -51,16 +142,40 @@ def cflags_C(
     f'LDFLAGS{suffix}=' + ' '.join(ld + ld_extra),
   ]
 
-def configure(component: str, cwd: Path, args: List[str]):
-  res = subprocess.run(
-    ['../configure', *args],
+def configure(component: str, cwd: Path, args: List[str], src: Path):
+  res = run(
+    f'{component} (configure)',
+    [src / 'configure', *args],
     cwd = cwd,
+    env = environ(),
   )
   if res.returncode != 0:
     message = f'Build fail: {component} configure returned {res.returncode}'
     logging.critical(message)
     raise Exception(message)
 
+def _feed(h, part):
+  if isinstance(part, Path):
+    if part.is_dir():
+      for file in sorted(part.rglob('*')):
+        if file.is_file():
+          h.update(str(file.relative_to(part)).encode() + b'\0')
+          h.update(file.read_bytes())
+    elif part.exists():
+      h.update(part.read_bytes())
+  elif isinstance(part, (list, tuple)):
+    for item in part:
+      _feed(h, item)
+  else:
+    h.update(repr(part).encode())
+  h.update(b'\0')
+
+# strings are hashed by value, paths by content (directories recursively)
+def digest(*parts) -> str:
+  h = sha256()
+  _feed(h, parts)
+  return h.hexdigest()
+
 def ensure(path: Path):
   path.mkdir(parents = True, exist_ok = True)
 
@@ -93,10 +208,22 @@ def fix_limits_h(limits_h: Path, gcc_src: Path):
     f.writelines(open(gcc_src / 'gcc' / 'limity.h', 'r').read())
 
 def make_custom(component: str, cwd: Path, extra_args: List[str], jobs: int):
-  res = subprocess.run(
-    ['make', *extra_args, f'-j{jobs}'],
-    cwd = cwd,
-  )
+  if jobs > 1 and jobserver.current():
+    # parallelism comes from the shared jobserver in MAKEFLAGS
+    res = run(
+      component,
+      ['make', *extra_args],
+      cwd = cwd,
+      env = jobserver.environ(environ()),
+      pass_fds = jobserver.pass_fds(),
+    )
+  else:
+    res = run(
+      component,
+      ['make', *extra_args, f'-j{jobs}'],
+      cwd = cwd,
+      env = environ(),
+    )
   if res.returncode != 0:
     message = f'Build fail: {component} make returned {res.returncode}'
     logging.critical(message)
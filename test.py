@@ -201,6 +201,11 @@ def main():
     os.environ['WINEDEBUG'] = '-all'
     xmake_verbose = []
 
+  if len(config.branches) > 1:
+    message = 'Test fail: test one branch at a time'
+    logging.critical(message)
+    raise Exception(message)
+
   logging.info("testing GCC %s", config.branch)
 
   ver = BRANCHES[config.branch]